@@ -1,3 +1,18 @@
+import importlib, importlib.util
 import pkg_resources
 
-from oskb.oskb import *
+# Everything in oskb.oskb (Keyboard, oskbCopy, PRESSED, ...) can be used as oskb.<name>, like a
+# "from oskb.oskb import *" would. That module needs PyQt5, and the rest of the package (model, gesture,
+# timing, geometry, trie, swipe) doesn't, so it is only imported when one of its names is first used.
+
+
+def __getattr__(name):
+    if name.startswith("__"):
+        raise AttributeError(name)
+    # Submodules, also for "from oskb import <module>", which asks for the attribute first
+    if importlib.util.find_spec("oskb." + name):
+        return importlib.import_module("oskb." + name)
+    widget = importlib.import_module("oskb.oskb")
+    if name.startswith("_") or not hasattr(widget, name):
+        raise AttributeError("module 'oskb' has no attribute " + repr(name))
+    return getattr(widget, name)
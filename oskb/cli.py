@@ -1,4 +1,4 @@
-import argparse, sys, os, psutil, subprocess, re, signal
+import argparse, sys, os, psutil, subprocess, re, signal, atexit
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtCore import Qt, QTimer
 import pkg_resources
@@ -74,6 +74,63 @@ specified.""",
         action="store_true",
     )
     ap.add_argument("--justshow", help="Show keyboard, do not send keys to OS.", action="store_true")
+    ap.add_argument(
+        "--painted",
+        help="""Draw each keyboard view as a single widget instead of using a button widget for every key.
+Uses far fewer widgets, which makes starting up and switching views a lot faster on slow hardware.""",
+        action="store_true",
+    )
+    ap.add_argument(
+        "--keycache",
+        help="""Keep up to this many kilobytes of rendered keys in memory, so keys that look the same as
+ones drawn before are repainted from that cache. Only works in painted mode, so this implies --painted.""",
+        metavar="<kb>",
+        type=int,
+    )
+    ap.add_argument(
+        "--fontscale",
+        help="""Only scale the fonts when the keyboard is resized, instead of re-rendering all stylesheets.
+Faster on slow hardware, but margins and rounded corners keep the size they had when first shown.""",
+        action="store_true",
+    )
+    ap.add_argument(
+        "--optimistic",
+        help="""Keys that do something else when tapped twice send their normal key right away, and
+BackSpace it if the second tap comes. Takes away the wait after tapping such keys.""",
+        action="store_true",
+    )
+    ap.add_argument(
+        "--adaptive",
+        help="""Learn how long presses and how quick double taps are for each key from how you type,
+instead of using fixed times. What is learned is kept in ~/.config/oskb/timing.json.""",
+        action="store_true",
+    )
+    ap.add_argument(
+        "--predict",
+        help="""Show suggestions for the word being typed in keyboards that have a prediction row, from a
+word trie built with 'python -m oskb.trie'.""",
+        metavar="<triefile>",
+    )
+    ap.add_argument(
+        "--swipe",
+        help="""Type words by dragging a finger across their letters on a touch screen. Uses the words
+from --predict, and needs NumPy.""",
+        action="store_true",
+    )
+    ap.add_argument(
+        "--repeat",
+        help="""Have the system repeat keys that are held down, after <delay> milliseconds and then every
+<period> milliseconds. Keys with a long press or double tap action never repeat.""",
+        nargs=2,
+        type=int,
+        metavar=("<delay>", "<period>"),
+    )
+    ap.add_argument(
+        "--trusted",
+        help="""Do not check the keyboard files for mistakes when loading them. Saves some startup time
+for keyboard files that are known to be good.""",
+        action="store_true",
+    )
 
     loc = ap.add_argument_group(title="Controlling position on screen")
     loc.add_argument("-x", help="Absolute position of left side of keyboard", metavar="<x>", type=int)
@@ -171,7 +228,7 @@ def main():
     app = QApplication([])
 
     #
-    # Make sure Ctrl-C can interrupt oskb
+    # Make sure Ctrl-C (or being told to terminate) can interrupt oskb
     #
 
     def sigint_handler(*args):
@@ -179,6 +236,7 @@ def main():
         QApplication.quit()
 
     signal.signal(signal.SIGINT, sigint_handler)
+    signal.signal(signal.SIGTERM, sigint_handler)
     timer = QTimer()
     timer.start(250)
     timer.timeout.connect(lambda: None)
@@ -188,6 +246,41 @@ def main():
     #
 
     keyboard = oskb.Keyboard()
+
+    # Whatever way oskb ends, keys it sent as pressed get released. An exception ends it too, instead of
+    # PyQt aborting, so that happens then as well.
+    atexit.register(keyboard.releaseKeys)
+    # What adaptive timing learned since it was last saved is written out then as well
+    atexit.register(keyboard.saveTiming)
+
+    def excepthook(*args):
+        sys.__excepthook__(*args)
+        QApplication.exit(-1)
+
+    sys.excepthook = excepthook
+    if cmdline.trusted:
+        keyboard.setTrusted(True)
+    if cmdline.optimistic:
+        keyboard.setOptimisticDoubles(True)
+    if cmdline.adaptive:
+        keyboard.setAdaptiveTiming(True)
+    if cmdline.predict:
+        keyboard.setPredictions(cmdline.predict)
+    if cmdline.swipe:
+        if not cmdline.predict:
+            sys.stderr.write("--swipe needs the words from --predict.\n")
+            sys.exit(-1)
+        try:
+            keyboard.setSwipeTyping(True)
+        except RuntimeError as e:
+            sys.stderr.write(str(e) + ".\n")
+            sys.exit(-1)
+    if cmdline.fontscale:
+        keyboard.setFontScaling(True)
+    if cmdline.painted or cmdline.keycache:
+        keyboard.setPaintedKeys(True)
+        if cmdline.keycache:
+            keyboard.setKeyCache(cmdline.keycache)
     if cmdline.float:
         keyboard.setWindowTitle("On-Screen Keyboard")
         keyboard.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.WindowDoesNotAcceptFocus)
@@ -275,7 +368,7 @@ def main():
     if not cmdline.justshow:
         plugged = False
         try:
-            plugged = keyboard.sendKeys(im.default().receiveKeys)
+            plugged = keyboard.sendKeys(im.default(cmdline.repeat).receiveKeys)
         except:
             sys.stderr.write("Could not set up the virtual keyboard.\n")
 
@@ -304,8 +397,7 @@ def main():
     # Load the keyboard files
     #
 
-    for k in load_keyboards:
-        keyboard.readKeyboard(k)
+    keyboard.readKeyboards(load_keyboards, threads=True)
 
     # Also works if no startup kbd is specified, because None will load first keyboard
     keyboard.setKeyboard(cmdline.start)
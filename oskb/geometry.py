@@ -0,0 +1,55 @@
+import math
+
+#
+# Where the keys of a view are, for deciding which key a touch was meant for. A touch well inside a key
+# is that key. A touch near the edge of a key, or in the gap between keys, could have been meant for any
+# key nearby, so those are scored: how likely a touch lands where it did if aimed at the centre of a key,
+# with the spread in each direction proportional to the size of that key, times how likely that key is
+# to come next if a prior is given (e.g. from a language model). The best scoring key wins.
+#
+# Coordinates are plain numbers, so there's no Qt in here.
+#
+
+# The inner part of a key, as a fraction of its width and height, where a touch is simply that key
+CERTAIN = 0.6
+
+# How far from a key a touch can be and still be meant for it, as a fraction of its width and height
+REACH = 0.5
+
+# Spread of touches aimed at the centre of a key, as a fraction of its width and height
+SPREAD = 0.4
+
+
+class KeyIndex:
+    # entries are (item, x, y, width, height)
+    def __init__(self, entries):
+        self._items = []
+        self._boxes = []
+        for item, x, y, w, h in entries:
+            if w <= 0 or h <= 0:
+                continue
+            self._items.append(item)
+            # centre, half sizes
+            self._boxes.append((x + w / 2, y + h / 2, w / 2, h / 2))
+
+    # The item the point was most likely meant for, None if nothing is within reach. prior(item) gives
+    # how likely that item is, any positive scale will do.
+    def resolve(self, x, y, prior=None):
+        candidates = []
+        for item, (cx, cy, hw, hh) in zip(self._items, self._boxes):
+            dx, dy = abs(x - cx), abs(y - cy)
+            if dx <= hw * CERTAIN and dy <= hh * CERTAIN:
+                return item
+            if dx <= hw * (1 + 2 * REACH) and dy <= hh * (1 + 2 * REACH):
+                candidates.append((item, dx / (hw * 2 * SPREAD), dy / (hh * 2 * SPREAD)))
+        best, bestscore = None, None
+        for item, zx, zy in candidates:
+            score = -(zx * zx + zy * zy) / 2
+            if prior:
+                p = prior(item)
+                if p <= 0:
+                    continue
+                score += math.log(p)
+            if bestscore is None or score > bestscore:
+                best, bestscore = item, score
+        return best
@@ -0,0 +1,196 @@
+from oskb import model
+
+#
+# The key state machine: turns presses and releases into single, double and long actions. Everything is
+# decided by the timestamps (in milliseconds) passed in with the events, so the same events always lead to
+# the same actions, however late they are delivered. Nothing in here waits or sets timers. Instead,
+# deadline() says when something will happen if no other event comes first, and the caller makes sure
+# poll() gets called then. There's only ever one long press deadline and one double tap deadline
+# that matters, so one timer for each is enough.
+#
+# Each press comes with a pointer id, so several keys can be down at the same time (one for each finger
+# on a touch screen). The mouse is MOUSE.
+#
+# Per pointer that is down:
+#
+#   - A key with only a single action does its PRESSED on press and its RELEASED on release, so what it
+#     sends stays down (and autorepeats, if that is on) while the key is held. A key with "repeat": false
+#     does both on press instead.
+#   - A key with a long action waits. Released before the long press deadline, it does its single action,
+#     otherwise the long action happens at the deadline and nothing happens on release.
+#   - A key with a double action is held back as "pending" until its double tap deadline. A second tap on
+#     it before then does the double action. The deadline passing or another key being pressed does the
+#     single action, unless the key is still held down then. In optimistic mode (see
+#     Keyboard.setOptimisticDoubles()) the single action of keys that can be taken back happens right
+#     away, and the second tap first sends what takes it back.
+#
+
+RELEASED = 0
+PRESSED = 1
+
+MOUSE = "mouse"
+
+
+class _Down:
+    __slots__ = ("key", "at", "longdeadline", "suppress")
+
+    def __init__(self, key, at):
+        self.key = key
+        self.at = at
+        self.longdeadline = None
+        # Nothing happens on release
+        self.suppress = False
+
+
+class _Pending:
+    __slots__ = ("key", "deadline", "fired")
+
+    def __init__(self, key, deadline, fired):
+        self.key = key
+        self.deadline = deadline
+        # Single action already happened (optimistic mode)
+        self.fired = fired
+
+
+class GestureMachine:
+    # act(action, direction) carries out a model.Action, compensate(key) sends what takes back the single
+    # action of a key in optimistic mode.
+    def __init__(self, act, compensate, longpress, doubleclick):
+        self._act = act
+        self._compensate = compensate
+        self.longpress = longpress
+        self.doubleclick = doubleclick
+        self.optimistic = False
+        # A timing.TimingModel, or None for the fixed times above
+        self.timing = None
+        # Put in front of key ids for the timing model, so the same key in different keyboards is different
+        self.prefix = ""
+        self._down = {}
+        self._pending = None
+
+    def press(self, pointer, key, t):
+        self.poll(t)
+        if pointer in self._down:
+            # Missed the release somehow
+            self.release(pointer, t)
+        pending = self._pending
+        if pending and pending.key is not key:
+            # Another key was pressed within the doubleclick timeout, so we must first process the
+            # previous key that was held back
+            self._pending = None
+            if not pending.fired:
+                self._tap(pending.key.single)
+            pending = None
+        if self.timing and isinstance(key, model.Key):
+            self.timing.pressed(self.prefix + key.keyid, t, secondtap=pending is not None)
+        down = _Down(key, t)
+        self._down[pointer] = down
+        if key.long:
+            down.longdeadline = t + self._longpressTimeout(key)
+        if key.double:
+            down.suppress = True
+            if pending:
+                self._pending = None
+                if pending.fired:
+                    self._compensate(key)
+                self._tap(key.double)
+            else:
+                fired = self.optimistic and undoable(key)
+                self._pending = _Pending(key, t + self._doubleclickTimeout(key), fired)
+                if fired:
+                    self._tap(key.single)
+        elif not key.long:
+            if isinstance(key, model.Key) and not key.repeat:
+                down.suppress = True
+                self._tap(key.single)
+            else:
+                self._act(key.single, PRESSED)
+
+    def release(self, pointer, t):
+        self.poll(t)
+        down = self._down.pop(pointer, None)
+        if not down:
+            return
+        key = down.key
+        if self.timing and isinstance(key, model.Key):
+            longpress = bool(key.long) and down.longdeadline is None
+            self.timing.released(self.prefix + key.keyid, t, longpress, bool(key.long))
+        if down.suppress:
+            return
+        if key.long:
+            if down.longdeadline is not None:
+                self._tap(key.single)
+        else:
+            self._act(key.single, RELEASED)
+
+    # Let go of everything without doing any more actions, e.g. when switching keyboards
+    def reset(self):
+        self._down.clear()
+        self._pending = None
+
+    # Do what was due at or before time t
+    def poll(self, t):
+        while True:
+            kind = None
+            deadline = None
+            for k in ("long", "double"):
+                d = self.deadline(k)
+                if d is not None and d <= t and (deadline is None or d < deadline):
+                    kind, deadline = k, d
+            if not kind:
+                return
+            if kind == "long":
+                self._longPress()
+            else:
+                self._doubleTimeout()
+
+    # The earliest time at which something happens by itself, for "long" or "double"
+    def deadline(self, kind):
+        if kind == "double":
+            return self._pending.deadline if self._pending else None
+        deadlines = [d.longdeadline for d in self._down.values() if d.longdeadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def _longPress(self):
+        down = min(
+            (d for d in self._down.values() if d.longdeadline is not None), key=lambda d: d.longdeadline
+        )
+        down.longdeadline = None
+        down.suppress = True
+        if self._pending and self._pending.key is down.key:
+            # The long press takes the place of whatever the double tap would do
+            self._pending = None
+        self._tap(down.key.long)
+
+    def _doubleTimeout(self):
+        pending = self._pending
+        self._pending = None
+        if pending.fired:
+            return
+        if any(d.key is pending.key for d in self._down.values()):
+            return
+        self._tap(pending.key.single)
+
+    def _tap(self, action):
+        self._act(action, PRESSED)
+        self._act(action, RELEASED)
+
+    def _longpressTimeout(self, key):
+        if self.timing and isinstance(key, model.Key):
+            return self.timing.longpressTimeout(self.prefix + key.keyid)
+        return self.longpress
+
+    def _doubleclickTimeout(self, key):
+        if self.timing and isinstance(key, model.Key):
+            return self.timing.doubleclickTimeout(self.prefix + key.keyid)
+        return self.doubleclick
+
+
+# Whether the single action of a key can be taken back by sending the compensate keycodes: it only sends
+# printable keys, and there's no long action that might happen instead.
+
+
+def undoable(key):
+    if key.long or not key.single:
+        return False
+    return all(cmd == "send" and args["printable"] for cmd, args in key.single.commands)
@@ -15,6 +15,6 @@ for module in pkg_resources.resource_listdir("oskb.im", ""):
 # Return a default handler for a given platform
 
 
-def default():
+def default(repeat=None):
     if sys.platform.startswith("linux"):
-        return UInput()
+        return UInput(repeat)
@@ -4,9 +4,21 @@ if sys.platform.startswith("linux"):
 
     import evdev
 
+    # With repeat set to (delay, period) in milliseconds, the kernel repeats keys that are held down, the
+    # way it does for a real keyboard. Keys only stay down while held if they have nothing but a single
+    # action, and don't say "repeat": false.
+
     class UInput:
-        def __init__(self):
-            self.uinput = evdev.UInput(name="oskb")
+        def __init__(self, repeat=None):
+            if repeat:
+                events = {evdev.ecodes.EV_KEY: evdev.ecodes.keys.keys(), evdev.ecodes.EV_REP: []}
+                self.uinput = evdev.UInput(events=events, name="oskb")
+                delay, period = repeat
+                self.uinput.write(evdev.ecodes.EV_REP, evdev.ecodes.REP_DELAY, delay)
+                self.uinput.write(evdev.ecodes.EV_REP, evdev.ecodes.REP_PERIOD, period)
+                self.uinput.syn()
+            else:
+                self.uinput = evdev.UInput(name="oskb")
 
         def receiveKeys(self, keycode, keyevent):
             self.uinput.write(evdev.ecodes.EV_KEY, keycode, keyevent)
@@ -0,0 +1,461 @@
+#
+# The in-memory model of a keyboard. It is built once from the JSON data as read from the keyboard file,
+# and every object keeps the dictionary it was made from in .data. That data is never changed: columns
+# with fewer rows than others get empty rows in the model only (see padRows() for the editor). Everything
+# the keyboard widget needs while running (widgets, style classes, sizes, selection state) lives in the
+# __slots__ of these objects, so it never ends up in the dictionaries, which stay exactly what is in the
+# file. If the data of a key or row is changed (as the editor does), calling reload() on it makes the
+# model catch up.
+#
+# No Qt in here, so this can be used without a display.
+#
+
+import re
+
+
+class Keyboard:
+    __slots__ = ("data", "name", "views", "widget", "stackindex")
+
+    def __init__(self, name, data):
+        self.data = data
+        self.name = name
+        self.views = {}
+        for viewname, viewdata in data.get("views", {}).items():
+            self.views[viewname] = View(viewname, viewdata)
+        self.widget = None
+        self.stackindex = 0
+
+    # Everything in the keyboard, for registering them by their data
+    def walk(self):
+        for view in self.views.values():
+            for column in view.columns:
+                for row in column.rows:
+                    yield row
+                    for key in row.keys:
+                        yield key
+
+
+class View:
+    __slots__ = (
+        "data",
+        "name",
+        "columns",
+        "widthinunits",
+        "heightinunits",
+        "widget",
+        "layout",
+        "stackindex",
+        "sheetsizes",
+        "keyindex",
+        "swipedecoder",
+    )
+
+    def __init__(self, name, data):
+        self.data = data
+        self.name = name
+        columndata = data.get("columns", [])
+        maxrows = max([len(c.get("rows", [])) for c in columndata] + [0])
+        self.columns = []
+        for ci, c in enumerate(columndata):
+            self.columns.append(Column(c, name, ci, maxrows))
+        self.widget = None
+        self.layout = None
+        self.stackindex = 0
+        self.sheetsizes = None
+        self.keyindex = None
+        self.swipedecoder = None
+        self.measure()
+
+    # Stores the width and height in standard key widths for the view and the width for each column
+    def measure(self):
+        total_height = 0
+        # Heights are only stored in first column
+        if self.columns:
+            for row in self.columns[0].rows:
+                total_height += row.height
+        total_width = 0
+        for column in self.columns:
+            largest_width = 0
+            for ri, row in reversed(list(enumerate(column.rows))):
+                if row.keys:
+                    totalweight = 0
+                    for key in row.keys:
+                        totalweight += key.width
+                    # Not counting frst row if there are widths already (reversed order)
+                    if totalweight > largest_width and (ri != 0 or totalweight == 0):
+                        largest_width = totalweight
+            column.widthinunits = largest_width
+            total_width += largest_width
+        self.widthinunits = max(total_width, 1)
+        self.heightinunits = max(total_height, 1)
+
+
+class Column:
+    __slots__ = ("data", "rows", "widthinunits")
+
+    # Columns with fewer rows than the view has get empty rows at the bottom. Those are only in the model,
+    # the data is left as it is (see padRows()).
+    def __init__(self, data, viewname, ci, rows=0):
+        self.data = data
+        rowdata = data.get("rows", [])
+        rowdata = rowdata + [{"keys": []} for ri in range(rows - len(rowdata))]
+        self.rows = [Row(r, viewname, ci, ri) for ri, r in enumerate(rowdata)]
+        self.widthinunits = 1
+
+
+class Row:
+    __slots__ = ("data", "keys", "type", "height", "widget", "cls", "selected")
+
+    # Rows don't have a stylesheet of their own
+    style = ""
+    renderedstyle = ""
+
+    def __init__(self, data, viewname, ci, ri):
+        self.data = data
+        if data.get("type") == "predictions":
+            # The prediction strip: keys that show suggested words, see predictionSlots()
+            self.type = "predictions"
+            keys = predictionSlots(data.get("count", PREDICTIONS))
+        else:
+            keys = data.get("keys", [])
+            # Rows without keys get a widget of their own, so there's something to click on in the editor
+            self.type = "row" if keys else "emptyrow"
+        self.keys = [Key(k, (viewname, ci, ri), ki) for ki, k in enumerate(keys)]
+        self.widget = None
+        self.cls = None
+        self.selected = False
+        self.reload()
+
+    def reload(self):
+        self.height = self.data.get("height", 1)
+
+
+# Adds the empty rows the model adds to short columns (see Column) to the data itself, for the editor,
+# which needs them to be there to put keys in them. Only for data that nothing else shares.
+def padRows(data):
+    for view in data.get("views", {}).values():
+        columns = view.get("columns", [])
+        maxrows = max([len(c.get("rows", [])) for c in columns] + [0])
+        for c in columns:
+            rowdata = c.setdefault("rows", [])
+            while len(rowdata) < maxrows:
+                rowdata.append({"keys": []})
+
+
+# A row with "type": "predictions" shows "count" suggestions for completing the word being typed. It
+# gets keys that are not in the file, each with a "predict" action for one of the suggestions.
+
+PREDICTIONS = 3
+
+
+def predictionSlots(count):
+    return [
+        {"type": "key", "class": "prediction", "single": {"predict": {"slot": slot}}} for slot in range(count)
+    ]
+
+
+class Key:
+    __slots__ = (
+        "data",
+        "type",
+        "width",
+        "caption",
+        "extracaptions",
+        "style",
+        "single",
+        "double",
+        "long",
+        "compensate",
+        "repeat",
+        "position",
+        "keyid",
+        "classes",
+        "cls",
+        "renderedstyle",
+        "selected",
+        "widget",
+        "labels",
+        "layout",
+        "stretchindex",
+        "fontscale",
+        "labelscales",
+    )
+
+    def __init__(self, data, position, ki):
+        self.data = data
+        # (viewname, ci, ri)
+        self.position = position
+        # "<viewname>/<ci>/<ri>/<ki>", the same as in "keys" when extending keyboards
+        self.keyid = "/".join([position[0], str(position[1]), str(position[2]), str(ki)])
+        self.classes = {}
+        self.cls = None
+        self.renderedstyle = None
+        self.selected = False
+        self.widget = None
+        self.labels = []
+        self.layout = None
+        self.stretchindex = 0
+        self.fontscale = None
+        self.labelscales = []
+        self.reload()
+
+    def reload(self):
+        d = self.data
+        self.type = d.get("type", "key")
+        self.width = d.get("width", 1)
+        self.caption = d.get("caption", "")
+        self.extracaptions = d.get("extracaptions") or {}
+        self.style = d.get("style", "")
+        self.single = Action(d.get("single"))
+        self.double = Action(d.get("double"))
+        self.long = Action(d.get("long"))
+        # Keycodes that undo the single action, for optimistic double taps. None means use the default.
+        self.compensate = _keycodesOrNothing(d["compensate"]) if "compensate" in d else None
+        # Whether the key stays down while held, so autorepeat (if on) repeats it. See gesture.py.
+        self.repeat = d.get("repeat", True)
+
+
+# An action ("single", "double" or "long") with the commands in it that actually do something, in the
+# order they are in the file. A key without that action gets an Action that is false. The arguments of
+# each command are compiled into a dictionary that has all of its entries, with defaults filled in,
+# keycodes parsed (see parseKeycodes()) and "until" turned into a regular expression. Compiling does not
+# complain about anything, that's what validate() is for: what it would reject ends up as a command that
+# does nothing here.
+
+
+class Action:
+    __slots__ = ("data", "commands", "modifier")
+
+    def __init__(self, data):
+        self.data = data or {}
+        commands = []
+        for cmd, args in self.data.items():
+            compiler = _COMMANDS.get(cmd)
+            if args and compiler:
+                commands.append((cmd, compiler(args)))
+        self.commands = tuple(commands)
+        modifier = self.data.get("modifier")
+        self.modifier = modifier.get("name", "") if modifier else None
+
+    def __bool__(self):
+        return bool(self.commands)
+
+
+# Pressing an empty row doesn't do anything
+Row.single = Row.double = Row.long = Action(None)
+
+
+def _compileSend(args):
+    return {
+        "keycodes": _keycodesOrNothing(args.get("keycode", "")),
+        "name": args.get("name", ""),
+        "printable": args.get("printable", True),
+    }
+
+
+def _compileModifier(args):
+    return {
+        "keycodes": _keycodesOrNothing(args.get("keycode", "")),
+        "name": args.get("name", ""),
+        "printable": args.get("printable", True),
+        "action": args.get("action", "toggle"),
+    }
+
+
+def _compileView(args):
+    try:
+        until = re.compile(args["until"]) if args.get("until") else None
+    except re.error:
+        until = None
+    return {"name": args.get("name", "default"), "until": until, "thenview": args.get("thenview")}
+
+
+def _compileKeyboard(args):
+    return {"name": args.get("name", "")}
+
+
+def _compilePredict(args):
+    return {"slot": args.get("slot", 0)}
+
+
+_COMMANDS = {
+    "send": _compileSend,
+    "modifier": _compileModifier,
+    "view": _compileView,
+    "keyboard": _compileKeyboard,
+    "predict": _compilePredict,
+}
+
+
+# "42+2;57" becomes ((42, 2), (57,)): press and release shift and 2, then space.
+
+_KEYCODES = re.compile(r"\d+(\+\d+)*(;\d+(\+\d+)*)*")
+
+
+def parseKeycodes(keystr):
+    if not isinstance(keystr, str) or not _KEYCODES.fullmatch(keystr):
+        raise ValueError("bad keycode " + repr(keystr))
+    return tuple(tuple(int(k) for k in keys.split("+")) for keys in keystr.split(";"))
+
+
+def _keycodesOrNothing(keystr):
+    try:
+        return parseKeycodes(keystr)
+    except ValueError:
+        return ()
+
+
+#
+# A keyboard file can say "extends": "<other keyboard file>" to start from that keyboard and only list
+# what is different. Everything at the top level of the file replaces what the base has, except for:
+#
+#   "views": views that replace the ones of the same name in the base, or are added. A view that is null
+#            is taken out.
+#   "keys":  keys that replace single keys in the base, by "<viewname>/<column>/<row>/<key>", counting
+#            from 0. That way a layout for another language only needs the keys that differ.
+#
+# extend() returns the keyboard that results. Everything that is not overridden is shared with the base
+# rather than copied, so the result must be treated as read-only, just like the base.
+#
+
+
+def extend(base, derived):
+    kbd = dict(base)
+    for field, value in derived.items():
+        if field not in ("extends", "views", "keys"):
+            kbd[field] = value
+    views = dict(base.get("views", {}))
+    for viewname, view in derived.get("views", {}).items():
+        if view is None:
+            views.pop(viewname, None)
+        else:
+            views[viewname] = view
+    kbd["views"] = views
+    keys = derived.get("keys", {})
+    _check(type(keys) == dict, "keys", "not a JSON object")
+    # Objects on the way to overridden keys are copied once, after which they are ours to change
+    own = set()
+
+    def _own(container, index):
+        item = container[index]
+        if id(item) not in own:
+            item = dict(item) if type(item) == dict else list(item)
+            own.add(id(item))
+            container[index] = item
+        return item
+
+    for where, keydata in keys.items():
+        parts = where.split("/")
+        _check(len(parts) == 4 and all(p.isdigit() for p in parts[1:]), "keys/" + where, "not a key position")
+        viewname, ci, ri, ki = parts[0], int(parts[1]), int(parts[2]), int(parts[3])
+        try:
+            view = _own(views, viewname)
+            columns = _own(view, "columns")
+            rows = _own(_own(columns, ci), "rows")
+            keylist = _own(_own(rows, ri), "keys")
+            keylist[ki] = keydata
+        except (KeyError, IndexError, TypeError):
+            _check(False, "keys/" + where, "no such key in the base keyboard")
+    return kbd
+
+
+#
+# validate() checks a keyboard as read from a file before anything is built from it, so mistakes show
+# up when loading instead of when someone presses the key in question. It raises RuntimeError saying
+# where in the file the first problem is.
+#
+
+KEY_TYPES = ("key", "spacer")
+# "emptyrow" is in files saved by older versions of the editor
+ROW_TYPES = ("row", "emptyrow", "predictions")
+MODIFIER_ACTIONS = ("toggle", "lock")
+
+
+def validate(data):
+    _check(type(data) == dict, "", "keyboard is not a JSON object")
+    views = data.get("views")
+    _check(type(views) == dict and views, "views", "no views")
+    _check("default" in views, "views", 'there is no "default" view')
+    for field in ("description", "keymap", "style"):
+        _check(type(data.get(field, "")) == str, field, "not a string")
+    for viewname, view in views.items():
+        where = "views/" + viewname
+        _check(type(view) == dict, where, "not a JSON object")
+        columns = view.get("columns")
+        _check(type(columns) == list and columns, where, "no columns")
+        for ci, column in enumerate(columns):
+            cwhere = where + "/columns/" + str(ci)
+            _check(type(column) == dict and type(column.get("rows", [])) == list, cwhere, "no list of rows")
+            for ri, row in enumerate(column.get("rows", [])):
+                rwhere = cwhere + "/rows/" + str(ri)
+                _check(type(row) == dict and type(row.get("keys", [])) == list, rwhere, "no list of keys")
+                _checkNumber(row, "height", rwhere)
+                rowtype = row.get("type", "row")
+                _check(rowtype in ROW_TYPES, rwhere + "/type", "unknown type " + repr(rowtype))
+                if rowtype == "predictions":
+                    count = row.get("count", PREDICTIONS)
+                    _check(type(count) == int and count > 0, rwhere + "/count", "not a number above 0")
+                for ki, key in enumerate(row.get("keys", [])):
+                    _validateKey(key, views, rwhere + "/keys/" + str(ki))
+
+
+def _validateKey(key, views, where):
+    _check(type(key) == dict, where, "not a JSON object")
+    _check(key.get("type", "key") in KEY_TYPES, where + "/type", "unknown type " + repr(key.get("type")))
+    _checkNumber(key, "width", where)
+    for field in ("caption", "class", "style"):
+        _check(type(key.get(field, "")) == str, where + "/" + field, "not a string")
+    _check(type(key.get("repeat", True)) == bool, where + "/repeat", "not true or false")
+    if "compensate" in key:
+        try:
+            parseKeycodes(key["compensate"])
+        except ValueError as e:
+            _check(False, where + "/compensate", str(e))
+    extracaptions = key.get("extracaptions", {})
+    _check(type(extracaptions) == dict, where + "/extracaptions", "not a JSON object")
+    for cssclass, txt in extracaptions.items():
+        _check(type(txt) == str, where + "/extracaptions/" + cssclass, "not a string")
+    for actionname in ("single", "double", "long"):
+        action = key.get(actionname, {})
+        awhere = where + "/" + actionname
+        _check(type(action) == dict, awhere, "not a JSON object")
+        for cmd, args in action.items():
+            cwhere = awhere + "/" + cmd
+            _check(cmd in _COMMANDS, cwhere, "unknown command")
+            _check(type(args) == dict, cwhere, "not a JSON object")
+            if not args:
+                continue
+            if cmd in ("send", "modifier"):
+                # No keycode is allowed, that's a key that doesn't send anything (yet). The editor saves
+                # keys like that.
+                keycode = args.get("keycode", "")
+                if keycode != "":
+                    try:
+                        parseKeycodes(keycode)
+                    except ValueError as e:
+                        _check(False, cwhere + "/keycode", str(e))
+                _check(type(args.get("printable", True)) == bool, cwhere + "/printable", "not true or false")
+            if cmd == "predict":
+                slot = args.get("slot", 0)
+                _check(type(slot) == int and slot >= 0, cwhere + "/slot", "not a number of 0 or more")
+            if cmd == "modifier":
+                modaction = args.get("action", "toggle")
+                _check(modaction in MODIFIER_ACTIONS, cwhere + "/action", "unknown action " + repr(modaction))
+            if cmd == "view":
+                for field in ("name", "thenview"):
+                    if field in args:
+                        _check(args[field] in views, cwhere + "/" + field, "no view " + repr(args[field]))
+                try:
+                    re.compile(args.get("until", ""))
+                except (re.error, TypeError):
+                    _check(False, cwhere + "/until", "not a regular expression")
+
+
+def _checkNumber(d, field, where):
+    value = d.get(field, 1)
+    _check(type(value) in (int, float) and value >= 0, where + "/" + field, "not a number of 0 or more")
+
+
+def _check(ok, where, problem):
+    if not ok:
+        raise RuntimeError("Keyboard file error in " + (where or "file") + ": " + problem)
@@ -1,8 +1,10 @@
-import os, sys, re, json, subprocess
+import os, sys, re, json, subprocess, time, math
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import pkg_resources
 
-from PyQt5.QtCore import QTimer, QRect, QSysInfo, QEvent, QSize, Qt
+from PyQt5.QtCore import QTimer, QRect, QPoint, QSysInfo, QEvent, QSize, Qt
+from PyQt5.QtGui import QPainter, QPixmapCache
 from PyQt5.QtWidgets import (
     QWidget,
     QPushButton,
@@ -13,11 +15,15 @@ from PyQt5.QtWidgets import (
     QLayout,
     QStackedLayout,
     QLabel,
+    QStyle,
+    QStyleOption,
 )
 
+from oskb import model, timing, gesture, geometry, trie, swipe
 
-RELEASED = 0
-PRESSED = 1
+
+RELEASED = gesture.RELEASED
+PRESSED = gesture.PRESSED
 
 COLUMN_MARGIN = 0.1
 
@@ -25,23 +31,52 @@ COLUMN_MARGIN = 0.1
 LONGPRESS_TIMEOUT = 350
 DOUBLECLICK_TIMEOUT = 200
 
+# With adaptive timing, save what was learned after this many new samples
+TIMING_SAVE_EVERY = 50
+
+# What optimistic double taps send to undo the single action by default: BackSpace
+OPTIMISTIC_COMPENSATE = "14"
+
+# Font size stylesheets are rendered at in font scaling mode, to find each widget's relative font size
+FONTSCALE_REFERENCE = 100
+
+# How long a touch on a letter key has to stay put to not be the start of a swipe, in milliseconds
+SWIPE_DECIDE = 150
+
+# How far a touch has to move to be a swipe, as a fraction of the size of a key
+SWIPE_START = 0.6
+
+# Modifiers that can be active while typing a word for prediction: none, or shift for a capital
+_WORD_MODIFIERS = ([], ["shift"], ["rightshift"])
+
 # The keyboard file format has its own version numbering
-KEYBOARDFILE_VERSION = 1
+KEYBOARDFILE_VERSION = 2
 
 
 class Keyboard(QWidget):
     def __init__(self):
         super().__init__()
         self._modifiers = {}
+        # Active modifiers as a bitmask, see _updateModMask(), and per send command what it sends for each
+        # mask, see _sendEntry()
+        self._modbits = {}
+        self._modmask = 0
+        self._sendtables = {}
         self._flashmodifiers = True
-        # This is all for the key-detection state-machine
-        self._longpresswait = False
-        self._longtimer = QTimer()
-        self._stopsinglepress = False
-        self._doublebutton = None
-        self._doubletimer = QTimer()
-        self._doubletimer.setSingleShot(True)
-        self._doubletimer.timeout.connect(self._doubleTimeout)
+        # This is all for the key-detection state-machine, see gesture.py. It gets one timer for long
+        # presses and one for double taps, which are set to whatever its next deadline is.
+        self._gestures = gesture.GestureMachine(
+            self._doAction, self._compensateKey, LONGPRESS_TIMEOUT, DOUBLECLICK_TIMEOUT
+        )
+        self._gesturetimers = {}
+        for kind in ("long", "double"):
+            timer = QTimer()
+            timer.setSingleShot(True)
+            timer.timeout.connect(self._gestureTimeout)
+            self._gesturetimers[kind] = timer
+        self._timing = None
+        self._timingfile = None
+        self._compensate = model.parseKeycodes(OPTIMISTIC_COMPENSATE)
 
         self._viewindex = None
         self._kbdname = None
@@ -49,7 +84,11 @@ class Keyboard(QWidget):
         self._viewuntil = None
         self._thenview = None
 
+        # The keyboards as read from the files, and the model built from each of them by initKeyboards()
         self._kbds = {}
+        self._models = {}
+        # Rows and keys in each keyboard's model by id() of their data, see keyFor()
+        self._bydata = {}
 
         # Create the special 'chooser' keyboard that shows all the loaded keyboards
         self._kbds["_chooser"] = {
@@ -72,6 +111,8 @@ class Keyboard(QWidget):
         self._viewname = "default"
         self._kbd = None
         self._sendkeys = None
+        # Keycodes sent as pressed and not released yet, in the order they were pressed. See _sendKey()
+        self._keysdown = {}
         self._sendmapchanges = None
         self._sendscreenstate = None
         self._buttonhandler = self._oskbButtonHandler
@@ -79,6 +120,36 @@ class Keyboard(QWidget):
 
         self._kbdstack = QStackedLayout(self)
 
+        # Buttons under each finger on a touch screen, by touch point id
+        self._touches = {}
+        self._keyprior = None
+        self.setAttribute(Qt.WA_AcceptTouchEvents)
+
+        # Word prediction, see setPredictions()
+        self._trie = None
+        self._word = ""
+        self._suggestions = []
+        # What to send to type each character, by keyboard name. See _charAction()
+        self._charactions = {}
+        # Swipe typing, see setSwipeTyping(). Touches that might become a swipe, by touch point id.
+        self._swipe = False
+        self._lexicon = None
+        self._swipes = {}
+        self._swipetimer = QTimer()
+        self._swipetimer.setSingleShot(True)
+        self._swipetimer.timeout.connect(self._swipeTimeout)
+
+        self._stylecache = {}
+        self._stylesizes = None
+        self._appliedsheet = None
+        self._fontscaling = False
+        self._painted = False
+        self._keycache = False
+        self._keycachegeneration = 0
+        self._trusted = False
+        # Keyboard files as parsed, by where they were found. See _parseKeyboardFile()
+        self._parsecache = {}
+
         self._stylesheet = pkg_resources.resource_string("oskb", "default.css").decode("utf-8")
 
     #
@@ -93,13 +164,27 @@ class Keyboard(QWidget):
     # Recalculate the fontsize and mrgaing and change the stylesheets when resizing
     def resizeEvent(self, event):
         QWidget.resizeEvent(self, event)
+        self._keycachegeneration += 1
+        for kbd in self._models.values():
+            for view in kbd.views.values():
+                view.keyindex = None
+                view.swipedecoder = None
         if self._view and self.isVisible():
             self.updateKeyboard()
 
+    # Touch screens: every finger is followed on its own, so several keys can be down at the same time.
+    # Taking the touch events means Qt doesn't turn them into (one pointer's worth of) mouse events.
+    def event(self, event):
+        if event.type() in (QEvent.TouchBegin, QEvent.TouchUpdate, QEvent.TouchEnd, QEvent.TouchCancel):
+            self._touchEvent(event)
+            return True
+        return super().event(event)
+
     # We just store the stylesheet, and then only do the super().setStyleSheet() when we've
     # recalculated values in updateKeyboard()
     def setStyleSheet(self, stylesheet):
         self._stylesheet = stylesheet
+        self._resetStyles()
 
     #
     # Our own public
@@ -120,6 +205,7 @@ class Keyboard(QWidget):
 
     def sendKeys(self, function):
         if callable(function):
+            self.releaseKeys()
             self._sendkeys = function
             return True
         return False
@@ -135,32 +221,178 @@ class Keyboard(QWidget):
     def setFlashModifiers(self, mode):
         self._flashmodifiers = mode
 
+    # Learn the long press and double tap timings for each key from how the user types, see timing.py. What
+    # is learned is kept in the given file, or in the user's config directory.
+    def setAdaptiveTiming(self, mode, path=None):
+        if not mode:
+            self._timing = None
+        else:
+            self._timing = timing.TimingModel(LONGPRESS_TIMEOUT, DOUBLECLICK_TIMEOUT)
+            self._timingfile = path or timing.defaultPath()
+            self._timing.load(self._timingfile)
+        self._gestures.timing = self._timing
+
+    # Writes what adaptive timing learned since it was last saved. That happens by itself every
+    # TIMING_SAVE_EVERY samples, and should also be done when exiting so nothing is lost.
+    def saveTiming(self):
+        if self._timing and self._timing.unsaved():
+            try:
+                self._timing.save(self._timingfile)
+            except OSError:
+                # Not being able to keep them is no reason to stop typing
+                pass
+
+    # Normally the single action of a key that also has a double action waits until it's clear that no
+    # second tap is coming. In optimistic mode it happens right away, and if the second tap comes anyway,
+    # the compensate keycodes are sent to undo it before the double action. A key can have its own in
+    # "compensate". This is only done for keys that have no long action and only send printable keys as
+    # their single action, as only those can be taken back like that.
+    def setOptimisticDoubles(self, mode, compensate=OPTIMISTIC_COMPENSATE):
+        self._gestures.optimistic = mode
+        self._compensate = model.parseKeycodes(compensate)
+
+    # In font scaling mode the stylesheets are only rendered once per view, and resizing only changes the
+    # fonts of the keys. Margins and rounded corners stay at the size the view was first shown at.
+    def setFontScaling(self, mode):
+        self._fontscaling = mode
+        self._resetStyles()
+        if self._view and self.isVisible():
+            self.updateKeyboard()
+
+    # Draw each view with a single KeyGrid widget instead of having a QPushButton for every key. Button
+    # handlers then get passed a PaintedKey instead of the button, which also has the key data in .data
+    def setPaintedKeys(self, mode):
+        if mode == self._painted:
+            return
+        self._painted = mode
+        if self._kbdstack.count():
+            self.initKeyboards()
+
+    # In painted mode, keep the rendered faces of keys in a QPixmapCache of at most the given size in
+    # kilobytes, so repainting a key that looks like one drawn before is just drawing a pixmap. 0 turns
+    # the cache off.
+    def setKeyCache(self, kilobytes):
+        self._keycache = kilobytes > 0
+        self._keycachegeneration += 1
+        if self._keycache:
+            QPixmapCache.setCacheLimit(kilobytes)
+
+    # Skip checking keyboard files with model.validate() when reading them, for files that are known to be
+    # good. Mistakes in them then only show when the key in question is used, or not at all.
+    def setTrusted(self, mode):
+        self._trusted = mode
+
+    # Touches that are not clearly on one key go to the key they were most likely meant for (see
+    # geometry.py). The prior, if given, is called with a model.Key and returns how likely that key is to
+    # be next, e.g. from a language model. Any positive scale will do.
+    def setKeyPrior(self, prior=None):
+        self._keyprior = prior
+
+    # Rows with "type": "predictions" show suggestions for completing the word being typed, from a word
+    # trie built with "python -m oskb.trie" (see trie.py). Tapping one types the rest of the word and a
+    # space. None turns prediction off, the rows then stay empty.
+    def setPredictions(self, triefile):
+        if self._trie:
+            self._trie.close()
+        self._trie = trie.Trie(triefile) if triefile else None
+        self._lexicon = None
+        for kbd in self._models.values():
+            for view in kbd.views.values():
+                view.swipedecoder = None
+        self._word = ""
+        self._showPredictions()
+
+    # On a touch screen, dragging a finger across the letters of a word types that word and a space (see
+    # swipe.py). The words come from the trie set with setPredictions(). A touch on a letter key is held
+    # back until it's clear it's not the start of a swipe: it moves away from the key, is lifted, or stays
+    # put for SWIPE_DECIDE milliseconds. Needs NumPy.
+    def setSwipeTyping(self, mode):
+        if mode and not swipe.available():
+            raise RuntimeError("Swipe typing needs NumPy")
+        self._swipe = mode
+
     def readKeyboard(self, kbdfile):
-        kbd = None
+        return self.readKeyboards([kbdfile])[0]
+
+    # Reads a number of keyboard files and then sets up the chooser and all the widgets once, instead of
+    # once for every file as calling readKeyboard() for each would. With threads=True the files are read in
+    # parallel, which helps if reading them means waiting for slow storage. Nothing is added if any of the
+    # files can't be read. Returns the names of the keyboards.
+    #
+    # Keyboards that were read from the same files share their data, also when one extends the other (see
+    # model.extend()). Anything that wants to change the data it gets from getRawKbds() should put a copy
+    # in its place first, as the editor does.
+    def readKeyboards(self, kbdfiles, threads=False):
+        if threads and len(kbdfiles) > 1:
+            with ThreadPoolExecutor(max_workers=len(kbdfiles)) as executor:
+                kbds = list(executor.map(self._loadKeyboard, kbdfiles))
+        else:
+            kbds = [self._loadKeyboard(kbdfile) for kbdfile in kbdfiles]
+        kbdnames = []
+        for kbdfile, kbd in zip(kbdfiles, kbds):
+            kbdname = os.path.basename(kbdfile)
+            self._kbds[kbdname] = kbd
+            kbdnames.append(kbdname)
+        self._updateChooser()
+        self.initKeyboards()
+        return kbdnames
+
+    def _loadKeyboard(self, kbdfile):
+        kbd = self._resolveKeyboardFile(kbdfile, [])
+        if not self._trusted:
+            model.validate(kbd)
+        return kbd
+
+    # Returns the keyboard in a file with whatever it extends applied. Files named in "extends" are looked
+    # for next to the file that names them first, then among the keyboards that come with oskb.
+    def _resolveKeyboardFile(self, kbdfile, extending):
+        location, kbd = self._parseKeyboardFile(kbdfile)
+        if not kbd.get("extends"):
+            return kbd
+        if location in extending:
+            raise RuntimeError(kbdfile + " ends up extending itself")
+        basefile = kbd["extends"]
+        if type(location) == str:
+            nextto = os.path.join(os.path.dirname(location), basefile)
+            if os.access(nextto, os.R_OK):
+                basefile = nextto
+        base = self._resolveKeyboardFile(basefile, extending + [location])
+        return model.extend(base, kbd)
+
+    # Parsed files are kept, and only parsed again if they were changed on disk since. Returns where the
+    # file was found and what was in it, which is never changed after. When reading in threads, two of
+    # them may both parse a file they share. That's a bit of wasted work, but harmless.
+    def _parseKeyboardFile(self, kbdfile):
         if os.access(kbdfile, os.R_OK):
-            with open(kbdfile, "r", encoding="utf-8") as f:
+            location = os.path.abspath(kbdfile)
+            mtime = os.path.getmtime(location)
+            cached = self._parsecache.get(location)
+            if cached and cached[0] == mtime:
+                return location, cached[1]
+            with open(location, "r", encoding="utf-8") as f:
                 kbd = json.load(f)
         elif kbdfile == os.path.basename(kbdfile) and pkg_resources.resource_exists(
             "oskb", "keyboards/" + kbdfile
         ):
+            location, mtime = ("oskb", kbdfile), None
+            cached = self._parsecache.get(location)
+            if cached:
+                return location, cached[1]
             kbd = json.loads(pkg_resources.resource_string("oskb", "keyboards/" + kbdfile))
-        if not kbd:
+        else:
             raise FileNotFoundError("Could not find " + kbdfile)
-        if kbd.get("format") != "oskb keyboard":
+        if type(kbd) != dict or kbd.get("format") != "oskb keyboard":
             raise RuntimeError("Not an oskb keyboard file")
-        if kbd.get("formatversion") > KEYBOARDFILE_VERSION:
+        if kbd.get("formatversion", 1) > KEYBOARDFILE_VERSION:
             raise RuntimeError("oskb keyboard file for newer oskb version. You must upgrade.")
-        kbdname = os.path.basename(kbdfile)
-        self._kbds[kbdname] = kbd
-        self._updateChooser()
-        self.initKeyboards()
-        return os.path.basename(kbdfile)
+        self._parsecache[location] = (mtime, kbd)
+        return location, kbd
 
     def getView(self):
         return self._viewname
 
     def getViews(self):
-        return self._kbd["views"].keys()
+        return self._kbd.views.keys()
 
     def _updateChooser(self):
         if not self._kbds.get("_chooser"):
@@ -185,24 +417,26 @@ class Keyboard(QWidget):
                 kbdname = self._previouskeyboard
                 if self._previousgeometry != self.geometry():
                     newgeometry = self._previousgeometry
-        for n, k in self._kbds.items():
+        for n, k in self._models.items():
             if kbdname and kbdname != n:
                 continue
             if not kbdname and n.startswith("_"):
                 continue
             self._kbdname = n
             self._kbd = k
+            self._gestures.reset()
+            self._gestures.prefix = n + "/"
             # print("setKeybaord picked ", n)
             self._releaseModifiers()
-            if self._sendmapchanges and k.get("keymap"):
-                self._sendmapchanges(k.get("keymap"))
+            if self._sendmapchanges and k.data.get("keymap"):
+                self._sendmapchanges(k.data.get("keymap"))
             if newgeometry:
                 self.hide()
             if kbdname != "_minimized":
                 self._previouskeyboard = n
             self._previousgeometry = self.geometry()
-            self._kbdstack.setCurrentIndex(k.get("_stackindex", 0))
-            if self._kbd["views"].get(self._viewname):
+            self._kbdstack.setCurrentIndex(k.stackindex)
+            if self._kbd.views.get(self._viewname):
                 self.setView(self._viewname, newgeometry)
             else:
                 self.setView("default", newgeometry)
@@ -211,10 +445,12 @@ class Keyboard(QWidget):
 
     def setView(self, viewname, newgeometry=None):
         # print ("setView", viewname)
-        if self._kbd["views"].get(viewname):
-            self._view = self._kbd["views"][viewname]
+        if self._kbd.views.get(viewname):
+            self._view = self._kbd.views[viewname]
             self._viewname = viewname
-            self._kbd["_QWidget"].layout().setCurrentIndex(self._view["_stackindex"])
+            self._kbd.widget.layout().setCurrentIndex(self._view.stackindex)
+            if self._trie:
+                self._showPredictions()
             if newgeometry:
                 self.setGeometry(newgeometry)
                 self.show()
@@ -226,13 +462,18 @@ class Keyboard(QWidget):
     def getRawKbds(self):
         return self._kbds
 
+    # The model.Row or model.Key in the current keyboard that was built from the given row or key dictionary
+    def keyFor(self, data):
+        return self._bydata.get(self._kbdname, {}).get(id(data))
+
     #
     # initKeyboards sets up a QStackedLayout holding QWidgets for each keyboard, which in turn have a
     # QStackedlayout that holds a QWidget for each view within that keyboard. That has a QGridLayout with
     # QHboxLayouts in it that hold the individual key QPushButton widgets. It also sets the captions and
     # button actions for each key and figures out how many standard key widths and row vis there are in
     # all the views, which is used by updateKeyboard() to dynamically figure out how big the fonts, margins
-    # and rounded corners need to be.
+    # and rounded corners need to be. In painted mode (see setPaintedKeys()) each view is a KeyGrid instead,
+    # and keys and empty rows get a PaintedKey in place of their QPushButton.
     #
 
     def initKeyboards(self):
@@ -240,101 +481,92 @@ class Keyboard(QWidget):
         # Helper to return placeholder "empty row" widget
         def _makeEmptyRow(row):
             er = QPushButton(self)
+            er.data = row.data
+            er.key = row
             er.pressed.connect(partial(self._buttonhandler, er, PRESSED))
             er.released.connect(partial(self._buttonhandler, er, RELEASED))
             er.setMinimumSize(1, 1)
             er.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
             er.setProperty("class", "emptyrow")
-            row["_QWidget"] = er
-            row["type"] = "emptyrow"
-            er.data = row
+            row.cls = "emptyrow"
+            row.widget = er
             return er
 
         # Helper to return a QLayout to go in place of the QPushButton that contains it plus
         # any extra labels stacked on top
         def _makeCaptionLayout(k):
-            extracaptions = k.data.get("extracaptions", None)
-            if not extracaptions:
+            if not k.key.extracaptions:
                 return False
             # ecl = extra captions layout
             ecl = QStackedLayout()
             ecl.setStackingMode(QStackedLayout.StackAll)
             ecl.addWidget(k)
-            for cssclass, txt in extracaptions.items():
+            for cssclass, txt in k.key.extracaptions.items():
                 ql = QLabel(txt)
                 ql.setProperty("class", cssclass)
                 ql.setAttribute(Qt.WA_TransparentForMouseEvents)
                 ecl.addWidget(ql)
+                k.key.labels.append(ql)
             return ecl
 
-        def _maxRowsInView(view):
-            maxrows = 0
-            for column in view.get("columns", []):
-                maxrows = max(len(column.get("rows")), maxrows)
-            return maxrows
-
-        # This stores the width and height in standard key widths for each view.
-        def _storeWidthsAndHeights(view):
-            total_height = 0
-            # Heights are only stored in first column
-            column = view["columns"][0]
-            for ri, row in enumerate(column.get("rows", [])):
-                total_height += row.get("height", 1)
-            total_width = 0
-            for ci, column in enumerate(view.get("columns", [])):
-                largest_width = 0
-                for ri, row in reversed(list(enumerate(column.get("rows", [])))):
-                    if len(row.get("keys", [])):
-                        totalweight = 0
-                        for keydata in row.get("keys", []):
-                            w = keydata.get("width", 1)
-                            totalweight += w
-                        # Not counting frst row if there are widths already (reversed order)
-                        if totalweight > largest_width and (ri != 0 or totalweight == 0):
-                            largest_width = totalweight
-                column["_widthInUnits"] = largest_width
-                total_width += largest_width
-            view["_widthInUnits"] = max(total_width, 1)
-            view["_heightInUnits"] = max(total_height, 1)
+        # Helper for painted mode, returns a KeyGrid that draws the whole view
+        def _makeKeyGrid(view):
+            for ci, column in enumerate(view.columns):
+                for row in column.rows:
+                    for key in row.keys:
+                        key.widget = PaintedKey(key)
+                        self._storeClasses(key)
+                    if not row.keys:
+                        row.widget = PaintedKey(row)
+                        row.cls = "emptyrow"
+            return KeyGrid(self, view)
 
         # Start of initKeyboards() itself
 
         if self._kbdstack.itemAt(0):
             self._clearLayout(self._kbdstack)
+        self._models = {}
+        self._bydata = {}
+        self._charactions = {}
+        self._sendtables = {}
         ki = 0
-        for kbdname, kbd in self._kbds.items():
+        for kbdname, kbddata in self._kbds.items():
+            kbd = model.Keyboard(kbdname, kbddata)
+            self._models[kbdname] = kbd
+            self._bydata[kbdname] = {id(item.data): item for item in kbd.walk()}
             viewstack = QStackedLayout()
             vi = 0
-            for viewname, view in kbd.get("views", {}).items():
-                _storeWidthsAndHeights(view)
+            for viewname, view in kbd.views.items():
+                if self._painted:
+                    view.widget = _makeKeyGrid(view)
+                    viewstack.addWidget(view.widget)
+                    view.stackindex = vi
+                    vi += 1
+                    continue
                 grid = QGridLayout()
                 grid.setSpacing(0)
                 grid.setContentsMargins(0, 0, 0, 0)
-                for ci, column in enumerate(view.get("columns", [])):
-                    for ri in range(_maxRowsInView(view)):
-                        if ri < len(column["rows"]):
-                            row = column["rows"][ri]
-                        else:
-                            row = {"keys": []}
-                            column["rows"].append(row)
-                        keys = row.get("keys", [])
+                for ci, column in enumerate(view.columns):
+                    for ri, row in enumerate(column.rows):
                         kl = QHBoxLayout()
                         kl.setContentsMargins(0, 0, 0, 0)
                         kl.setSpacing(0)
-                        for keydata in keys:
-                            stretch = keydata.get("width", 1) * 10
-                            type = keydata.get("type", "key")
+                        for key in row.keys:
+                            stretch = int(key.width * 10)
                             k = QPushButton(self)
                             k.setMinimumSize(1, 1)
-                            keydata["_QWidget"] = k
-                            keydata["_selected"] = False
-                            k.data = keydata
+                            key.widget = k
+                            self._storeClasses(key)
+                            k.data = key.data
+                            k.key = key
                             k.pressed.connect(partial(self._buttonhandler, k, PRESSED))
                             k.released.connect(partial(self._buttonhandler, k, RELEASED))
                             k.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
                             k.setMinimumSize(1, 1)
-                            if type == "key":
-                                k.setText(keydata.get("caption", ""))
+                            key.layout = kl
+                            key.stretchindex = kl.count()
+                            if key.type == "key":
+                                k.setText(key.caption)
                                 # Multiple captions? Create a QStackedWidget overlays them all
                                 ecl = _makeCaptionLayout(k)
                                 if ecl:
@@ -343,286 +575,676 @@ class Keyboard(QWidget):
                                     kl.addWidget(k, stretch)
                             else:
                                 kl.addWidget(k, stretch)
-                        if not len(keys):
+                        if not row.keys:
                             er = _makeEmptyRow(row)
                             kl.addWidget(er)
-                        else:
-                            row["_QWidget"] = None
                         grid.addLayout(kl, ri, ci * 2)
                         if ci == 0:
-                            grid.setRowStretch(ri, row.get("height", 1) * 10)
-                    grid.setColumnStretch(ci * 2, column.get("_widthInUnits", 1) * 10)
+                            grid.setRowStretch(ri, int(row.height * 10))
+                    grid.setColumnStretch(ci * 2, int(column.widthinunits * 10))
                     if ci > 0:
                         spacercolumn = QHBoxLayout()
                         spacercolumn.addWidget(QWidget(None))
-                        grid.setColumnStretch((ci * 2) - 1, COLUMN_MARGIN * 10)
+                        grid.setColumnStretch((ci * 2) - 1, int(COLUMN_MARGIN * 10))
                         grid.addLayout(spacercolumn, 0, (ci * 2) - 1)
                 # Create with self as parent, then reparent to prevent startup flicker
-                view["_QWidget"] = QWidget(self)
-                view["_QWidget"].setLayout(grid)
-                viewstack.addWidget(view["_QWidget"])
-                view["_stackindex"] = vi
+                view.widget = QWidget(self)
+                view.widget.setLayout(grid)
+                view.layout = grid
+                viewstack.addWidget(view.widget)
+                view.stackindex = vi
                 vi += 1
-            kbd["_QWidget"] = QWidget(self)
-            kbd["_stackindex"] = ki
+            kbd.widget = QWidget(self)
+            kbd.stackindex = ki
             ki += 1
-            kbd["_QWidget"].setLayout(viewstack)
-            self._kbdstack.addWidget(kbd["_QWidget"])
+            kbd.widget.setLayout(viewstack)
+            self._kbdstack.addWidget(kbd.widget)
         self.setKeyboard(self._kbdname)
         # Qt keeps coming up with minimum sizes that are way too wide
         # Some sane number will have to go in at some point, I guess
         self.setMaximumSize(16777215, 16777215)
         self.setMinimumSize(1, 1)
 
-    def updateKeyboard(self):
+    # Precompute the class strings a key can have, one for each modifier state (None for keys that
+    # are not modifiers) and selection state, so updateKeyboard() only needs to look them up.
+    def _storeClasses(self, key):
+        viewname, ci, ri = key.position
+        head = [key.type, key.data.get("class", "")]
+        tail = ["view_" + viewname, "row" + str(ri + 1), "col" + str(ci + 1)]
+        if key.single.modifier is not None:
+            states = {0: ["modifier"], 1: ["held"], 2: ["locked"]}
+        else:
+            states = {None: []}
+        classes = {}
+        for modstate, modclasses in states.items():
+            for selected in (False, True):
+                sel = ["selected"] if selected else []
+                classes[(modstate, selected)] = " ".join(head + modclasses + sel + tail).strip()
+        key.classes = classes
+        key.cls = None
+        key.renderedstyle = None
+
+    # Apply changes to the caption, extra captions, class, style, actions or width of a single key of the
+    # current keyboard without recreating all the widgets. If the change needs the widgets for the key to
+    # be different (new type, different number of extra captions), everything is recreated after all and
+    # this returns False.
+    def refreshKey(self, keydata):
+        key = self.keyFor(keydata)
+        oldtype = key.type
+        key.reload()
+        viewname, ci, ri = key.position
+        view = self._kbd.views[viewname]
+        if not self._painted:
+            if key.type != oldtype or len(key.extracaptions) != len(key.labels):
+                self.initKeyboards()
+                return False
+            if key.type == "key":
+                key.widget.setText(key.caption)
+                for ql, (cssclass, txt) in zip(key.labels, key.extracaptions.items()):
+                    ql.setProperty("class", cssclass)
+                    ql.setText(txt)
+                    # re-polishes for the class
+                    ql.setStyleSheet("")
+            key.layout.setStretch(key.stretchindex, int(key.width * 10))
+        self._storeClasses(key)
+        view.measure()
+        self._relayoutView(view)
+        return True
+
+    # Same for the height of a row: pass the dictionary for that row in the first column.
+    def refreshRow(self, rowdata):
+        row = self.keyFor(rowdata)
+        for view in self._kbd.views.values():
+            if view.columns and any(r is row for r in view.columns[0].rows):
+                row.reload()
+                view.measure()
+                self._relayoutView(view)
+                return True
+        return False
 
-        # Helper function to dynamically recalculate some sizes in stylesheets
-        def fixStyle(stylesheet, fontsize, margin, radius):
-            if stylesheet == "":
-                return ""
-            # Replace the main calculated values
-            stylesheet = stylesheet.replace("_OSKB_FONTSIZE_", str(fontsize))
-            stylesheet = stylesheet.replace("_OSKB_MARGIN_", str(margin))
-            stylesheet = stylesheet.replace("_OSKB_RADIUS_", str(radius))
-            # And then all the percentages based thereon (Qt5 doesn't do percentages in fontsizes)
-            r = re.compile(r"font-size\s*:\s*(\d+)\%")
-            i = r.finditer(stylesheet)
-            for m in i:
-                stylesheet = stylesheet.replace(
-                    m.group(0), "font-size: " + str(int((fontsize / 100) * int(m.group(1)))) + "px",
-                )
-            return stylesheet
+    # Take new widths and heights of a view into account
+    def _relayoutView(self, view):
+        view.sheetsizes = None
+        view.keyindex = None
+        view.swipedecoder = None
+        if self._painted:
+            view.widget._layoutKeys()
+        else:
+            grid = view.layout
+            for ci, column in enumerate(view.columns):
+                grid.setColumnStretch(ci * 2, int(column.widthinunits * 10))
+            if view.columns:
+                for ri, row in enumerate(view.columns[0].rows):
+                    grid.setRowStretch(ri, int(row.height * 10))
+        if view is self._view:
+            self.updateKeyboard()
+
+    def updateKeyboard(self):
 
         if not self._view:
             return False
         # Calculate the font and margin sizes
-        kw = self.width() / self._view["_widthInUnits"]
-        kh = self.height() / self._view["_heightInUnits"]
+        kw = self.width() / self._view.widthinunits
+        kh = self.height() / self._view.heightinunits
         fontsize = min(max(int(min(kw / 1.5, kh / 2)), 5), 50)
         margin = int(fontsize / 15)
         radius = margin * 3
-        # Dynamically change the default and keyboard stylesheets
-        all_sheets = self._stylesheet + "\n\n" + self._kbd.get("style", "")
-        super().setStyleSheet(fixStyle(all_sheets, fontsize, margin, radius))
-        # Then adjust the stylesheets and class properties of all keys
-        for ci, column in enumerate(self._view.get("columns", [])):
-            for ri, row in enumerate(column.get("rows", [])):
-                rowwidget = row.get("_QWidget")
-                if rowwidget:
-                    if row.get("_selected", False):
-                        rowwidget.setProperty("class", "emptyrow selected")
-                    else:
-                        rowwidget.setProperty("class", "emptyrow")
-                    # It needs .setStyleSheet(""), not .repaint() to show the changes
-                    rowwidget.setStyleSheet("")
-                else:
-                    for keydata in row.get("keys", []):
-                        k = keydata.get("_QWidget")
-                        type = keydata.get("type", "key")
-                        classes = [type]
-                        classes.append(keydata.get("class", ""))
-                        if keydata.get("single") and keydata["single"].get("modifier"):
-                            modname = keydata["single"]["modifier"].get("name", "")
-                            moddata = self._modifiers.get(modname, {})
-                            modstate = moddata.get("state")
-                            if modstate == 1:
-                                classes.append("held")
-                            elif modstate == 2:
-                                classes.append("locked")
-                            else:
-                                classes.append("modifier")
-                        if keydata.get("_selected", False):
-                            classes.append("selected")
-                        classes.append("view_" + self._viewname)
-                        classes.append("row" + str(ri + 1))
-                        classes.append("col" + str(ci + 1))
-                        k.setProperty("class", " ".join(classes).strip())
-                        keystyle = keydata.get("style", "")
-                        k.setStyleSheet(fixStyle(keystyle, fontsize, margin, radius))
+        # Dynamically change the default and keyboard stylesheets. In font scaling mode these are rendered
+        # at fixed sizes once per view, and only the font sizes in the keys' own stylesheets change here.
+        all_sheets = self._stylesheet + "\n\n" + self._kbd.data.get("style", "")
+        fontscaling = self._fontScaling()
+        if fontscaling:
+            if not self._view.sheetsizes:
+                self._view.sheetsizes = (FONTSCALE_REFERENCE, margin, radius)
+                self._measureFontScales(all_sheets)
+            sheetsizes = self._view.sheetsizes
+        else:
+            sheetsizes = (fontsize, margin, radius)
+        sheet = _fixStyle(all_sheets, *sheetsizes)
+        if fontscaling:
+            sheet = _stripFontSizes(sheet)
+        # Setting a stylesheet makes Qt re-resolve the style of every child, so only do that if it changed
+        changed = False
+        if sheet != self._appliedsheet:
+            super().setStyleSheet(sheet)
+            self._appliedsheet = sheet
+            changed = True
+            # Cached key faces may depend on any of the stylesheets. Keys that only changed class or
+            # style get entries of their own, as those are in the cache key.
+            self._keycachegeneration += 1
+        # Then adjust the stylesheets and class properties of all keys. The class strings are precomputed
+        # by initKeyboards(), so this is a lookup, and the property is only set if it actually changed.
+        for column in self._view.columns:
+            for row in column.rows:
+                if row.widget:
+                    rowclass = "emptyrow selected" if row.selected else "emptyrow"
+                    if rowclass != row.cls:
+                        row.cls = rowclass
+                        changed = True
+                        if not self._painted:
+                            row.widget.setProperty("class", rowclass)
+                            # It needs .setStyleSheet(""), not .repaint() to show the changes
+                            row.widget.setStyleSheet("")
+                    continue
+                for key in row.keys:
+                    keyclass = key.classes[self._keyState(key)]
+                    keystyle = self._keyStyle(key.style, *sheetsizes)
+                    if fontscaling:
+                        keystyle = _scaledStyle(keystyle, key.fontscale, fontsize)
+                    if keyclass != key.cls or keystyle != key.renderedstyle:
+                        key.cls = keyclass
+                        key.renderedstyle = keystyle
+                        changed = True
+                        if not self._painted:
+                            key.widget.setProperty("class", keyclass)
+                            # Also needed after only changing the class, it re-polishes the widget
+                            key.widget.setStyleSheet(keystyle)
+                    if fontscaling:
+                        for ql, scale in zip(key.labels, key.labelscales):
+                            labelstyle = _scaledStyle("", scale, fontsize)
+                            if labelstyle != ql.styleSheet():
+                                ql.setStyleSheet(labelstyle)
+        if self._painted and changed:
+            self._view.widget.update()
+
+    # Index into the precomputed class strings: modifier state (None if not a modifier) and selection
+    def _keyState(self, key):
+        modstate = None
+        modname = key.single.modifier
+        if modname is not None:
+            modstate = self._modifiers.get(modname, {}).get("state", 0)
+            if modstate not in (1, 2):
+                modstate = 0
+        return (modstate, key.selected)
+
+    # Font scaling mode: render all the stylesheets for the view at the reference font size and see what
+    # font size Qt ends up giving each key and extra caption. The ratio of that to the reference is what
+    # the calculated font size gets multiplied with on every resize. The font sizes are then taken out
+    # of the stylesheets, and each key and caption gets its scaled size in a stylesheet of its own.
+    def _measureFontScales(self, all_sheets):
+        sheetsizes = self._view.sheetsizes
+        super().setStyleSheet(_fixStyle(all_sheets, *sheetsizes))
+        self._appliedsheet = None
+        for column in self._view.columns:
+            for row in column.rows:
+                if row.widget:
+                    continue
+                for key in row.keys:
+                    keyclass = key.classes[self._keyState(key)]
+                    keystyle = _fixStyle(key.style, *sheetsizes)
+                    key.widget.setProperty("class", keyclass)
+                    key.widget.setStyleSheet(keystyle)
+                    key.cls = keyclass
+                    key.renderedstyle = keystyle
+                    key.fontscale = _measureFontScale(key.widget)
+                    for ql in key.labels:
+                        ql.setStyleSheet("")
+                    key.labelscales = [_measureFontScale(ql) for ql in key.labels]
+
+    # Font scaling needs the keys to be widgets, so it does not happen in painted mode
+    def _fontScaling(self):
+        return self._fontscaling and not self._painted
+
+    # Forget everything rendered from the stylesheets, so that the next updateKeyboard() starts over
+    def _resetStyles(self):
+        self._appliedsheet = None
+        self._stylecache.clear()
+        self._stylesizes = None
+        for kbd in self._models.values():
+            for view in kbd.views.values():
+                view.sheetsizes = None
+
+    # Rendered per-key stylesheets are cached by style text and the calculated sizes, so keys with the
+    # same style share one string and _fixStyle() runs only once for each. Sizes change all at once on
+    # resize, so the cache is emptied whenever that happens.
+    def _keyStyle(self, keystyle, fontsize, margin, radius):
+        if keystyle == "":
+            return ""
+        if (fontsize, margin, radius) != self._stylesizes:
+            self._stylecache.clear()
+            self._stylesizes = (fontsize, margin, radius)
+        cachekey = (keystyle, fontsize, margin, radius, self._fontScaling())
+        rendered = self._stylecache.get(cachekey)
+        if rendered is None:
+            rendered = _fixStyle(keystyle, fontsize, margin, radius)
+            if self._fontScaling():
+                rendered = _stripFontSizes(rendered)
+            self._stylecache[cachekey] = rendered
+        return rendered
 
 
     #
-    # The part here is the low-level button handling. It takes care of calling _doAction() with PRESSED and
-    # RELEASED with pointers to either the "single", "double" or "long" sub-dictionaries for that button,
-    # handling all the nitty-gritty. Bit involved.., Maybe only touch when wide awake and concentrated.
+    # The part here is the low-level button handling. The GestureMachine in gesture.py decides when to call
+    # _doAction() with PRESSED and RELEASED with either the "single", "double" or "long" action of the
+    # model.Key for that button. All that's left here is feeding it events and setting its timers.
     #
 
     def _oskbButtonHandler(self, button, direction):
-        sng = button.data.get("single")
-        dbl = button.data.get("double")
-        lng = button.data.get("long")
+        self._gestureEvent(gesture.MOUSE, button, direction)
+
+    def _gestureEvent(self, pointer, button, direction, t=None):
         if direction == PRESSED:
-            if self._doublebutton and self._doublebutton != button:
-                # Another key was pressed within the doubleclick timeout, so we must
-                # first process the previous key that was held back
-                self._doAction(self._doublebutton.data.get("single"), PRESSED)
-                self._doAction(self._doublebutton.data.get("single"), RELEASED)
-                self._doublebutton = None
-                self._doubletimer.stop()
-            self._stopsinglepress = False
-            if lng or dbl:
-                if lng:
-                    self._longtimer = QTimer()
-                    self._longtimer.setSingleShot(True)
-                    self._longtimer.timeout.connect(partial(self._longPress, lng))
-                    self._longtimer.start(LONGPRESS_TIMEOUT)
-                if dbl:
-                    self._stopsinglepress = True
-                    if self._doubletimer.isActive():
-                        self._doubletimer.stop()
-                        self._doAction(dbl, PRESSED)
-                        self._doAction(dbl, RELEASED)
-                        self._doublebutton = None
-                    else:
-                        self._doublebutton = button
-                        self._doubletimer.start(DOUBLECLICK_TIMEOUT)
+            self._gestures.press(pointer, button.key, _now() if t is None else t)
+        else:
+            self._gestures.release(pointer, _now())
+        self._armGestureTimers()
+        if self._timing and self._timing.unsaved() >= TIMING_SAVE_EVERY:
+            self.saveTiming()
+
+    def _gestureTimeout(self):
+        self._gestures.poll(_now())
+        self._armGestureTimers()
+
+    def _armGestureTimers(self):
+        now = _now()
+        for kind, timer in self._gesturetimers.items():
+            deadline = self._gestures.deadline(kind)
+            if deadline is None:
+                timer.stop()
             else:
-                self._doAction(sng, PRESSED)
+                timer.start(max(int(deadline - now) + 1, 0))
+
+    # Touch points go through the state machine with their own ids when the default handler is in use. A
+    # handler set with setButtonHandler() gets them like mouse clicks. Points are handled in the order the
+    # event lists them, and a cancelled touch releases its key like lifting the finger would.
+    def _touchEvent(self, event):
+        cancel = event.type() == QEvent.TouchCancel
+        for tp in event.touchPoints():
+            state = tp.state()
+            pos = tp.pos().toPoint()
+            if cancel or state & Qt.TouchPointReleased:
+                button = self._touches.pop(tp.id(), None)
+                if button and not self._swipeEnd(tp.id(), cancel):
+                    self._touchButton(tp.id(), button, RELEASED)
+            elif state & Qt.TouchPointPressed:
+                button = self._buttonAt(pos)
+                if button:
+                    self._touches[tp.id()] = button
+                    if not self._swipeBegin(tp.id(), button, pos):
+                        self._touchButton(tp.id(), button, PRESSED)
+            elif state & Qt.TouchPointMoved:
+                self._swipeMove(tp.id(), pos)
+        event.accept()
+
+    def _touchButton(self, pointer, button, direction):
+        self._showDown(button, direction == PRESSED)
+        if self._buttonhandler == self._oskbButtonHandler:
+            self._gestureEvent(pointer, button, direction)
         else:
-            if not self._stopsinglepress:
-                if self._longtimer.isActive():
-                    self._longtimer.stop()
-                    self._doAction(sng, PRESSED)
-                    self._doAction(sng, RELEASED)
-                else:
-                    self._doAction(sng, RELEASED)
-            self._stopsinglepress = False
-            self._longtimer.stop()
-
-    def _longPress(self, lng):
-        self._stopsinglepress = True
-        self._doAction(lng, PRESSED)
-        self._doAction(lng, RELEASED)
-
-    def _doubleTimeout(self):
-        if not self._stopsinglepress:
-            actiondict = self._doublebutton.data.get("single")
-            self._doAction(actiondict, PRESSED)
-            self._doAction(actiondict, RELEASED)
-        self._doublebutton = None
+            self._buttonhandler(button, direction)
+
+    # Qt only shows buttons as down for mouse presses
+    def _showDown(self, button, down):
+        if isinstance(button, PaintedKey):
+            button.down = down
+            self._view.widget.update(button.rect)
+        else:
+            button.setDown(down)
 
     #
-    # Higher level button handling: parses the actions from the action dictionary
+    # Swipe typing. A touch on a letter key, with no other touches going on, is kept in self._swipes as
+    # [button, time, path, swiping] instead of going to the state machine right away. If it turns into a
+    # swipe, the path is decoded when the finger is lifted. If not, the press goes to the state machine
+    # with the time it happened, so taps, double taps and long presses work as they always do.
     #
 
-    def _doAction(self, actiondict, direction):
-        if not actiondict:
+    # Returns True if the press is held back
+    def _swipeBegin(self, pointer, button, pos):
+        self._swipeDecide()
+        if not self._swipe or not self._trie or self._buttonhandler != self._oskbButtonHandler:
+            return False
+        if len(self._touches) > 1 or _swipeChar(button.key) is None:
+            return False
+        self._swipes[pointer] = [button, _now(), [(pos.x(), pos.y())], False]
+        self._showDown(button, True)
+        self._swipetimer.start(SWIPE_DECIDE)
+        return True
+
+    def _swipeMove(self, pointer, pos):
+        s = self._swipes.get(pointer)
+        if not s:
             return
-        for cmd, argdict in actiondict.items():
-            if not argdict:
-                continue
+        button, t, path, swiping = s
+        path.append((pos.x(), pos.y()))
+        if not swiping:
+            x, y = path[0]
+            r = self._keyRect(button.key)
+            if math.hypot(pos.x() - x, pos.y() - y) >= SWIPE_START * min(r.width(), r.height()):
+                s[3] = True
+                self._swipetimer.stop()
+                self._showDown(button, False)
+
+    # Returns True if the release was taken care of here
+    def _swipeEnd(self, pointer, cancel):
+        s = self._swipes.pop(pointer, None)
+        if not s:
+            return False
+        button, t, path, swiping = s
+        self._swipetimer.stop()
+        if not swiping:
+            if cancel:
+                self._showDown(button, False)
+                return True
+            self._gestureEvent(pointer, button, PRESSED, t)
+            return False
+        words = self._swipeDecoder().decode(path)
+        if words:
+            self._typeText(words[0] + " ")
+        return True
+
+    # Touches that stayed put long enough, or that another touch came along for, are not swipes
+    def _swipeDecide(self):
+        for pointer, (button, t, path, swiping) in list(self._swipes.items()):
+            if not swiping:
+                del self._swipes[pointer]
+                self._gestureEvent(pointer, button, PRESSED, t)
+
+    def _swipeTimeout(self):
+        self._swipeDecide()
+
+    # Made when first needed after the view was last laid out, like the key index
+    def _swipeDecoder(self):
+        view = self._view
+        if view.swipedecoder is None:
+            if self._lexicon is None:
+                self._lexicon = swipe.Lexicon(self._trie.words())
+            keys = {}
+            for column in view.columns:
+                for row in column.rows:
+                    for key in row.keys:
+                        ch = _swipeChar(key)
+                        if ch is not None and ch not in keys:
+                            r = self._keyRect(key)
+                            keys[ch] = (r.x(), r.y(), r.width(), r.height())
+            view.swipedecoder = swipe.SwipeDecoder(self._lexicon, keys)
+        return view.swipedecoder
+
+    # The key or empty row button (or PaintedKey) at a position in the keyboard, if any. With the default
+    # handler, touches near the edges of keys or between them are resolved to the most likely key, other
+    # handlers get exactly what was touched.
+    def _buttonAt(self, pos):
+        if self._buttonhandler == self._oskbButtonHandler and self._view:
+            if self._keyprior:
+                prior = lambda button: self._keyprior(button.key)
+            else:
+                prior = None
+            return self._keyIndex().resolve(pos.x(), pos.y(), prior)
+        w = self.childAt(pos)
+        if isinstance(w, KeyGrid):
+            return w.keyAt(w.mapFrom(self, pos))
+        if hasattr(w, "key"):
+            return w
+        return None
+
+    # Built when first needed after the view was last laid out, when the widgets are where they'll be
+    def _keyIndex(self):
+        view = self._view
+        if view.keyindex is None:
+            entries = []
+            for column in view.columns:
+                for row in column.rows:
+                    for key in row.keys:
+                        if key.type != "key":
+                            continue
+                        r = self._keyRect(key)
+                        entries.append((key.widget, r.x(), r.y(), r.width(), r.height()))
+            view.keyindex = geometry.KeyIndex(entries)
+        return view.keyindex
+
+    # Where a key of the current view is, in the keyboard's coordinates
+    def _keyRect(self, key):
+        b = key.widget
+        if isinstance(b, PaintedKey):
+            return QRect(self._view.widget.mapTo(self, b.rect.topLeft()), b.rect.size())
+        return QRect(b.mapTo(self, QPoint(0, 0)), b.size())
+
+    # Optimistic double taps: take back the single action that already happened
+    def _compensateKey(self, key):
+        compensate = self._compensate if key.compensate is None else key.compensate
+        self._injectKeys(compensate, PRESSED)
+        self._injectKeys(compensate, RELEASED)
+
+    #
+    # Higher level button handling: carries out the commands in a model.Action
+    #
+
+    def _doAction(self, action, direction):
+        for cmd, argdict in action.commands:
 
             if cmd == "send":
-                keycode = argdict.get("keycode", "")
-                keycodeplus = keycode
-                keyname = argdict.get("name", "")
-                printable = argdict.get("printable", True)
-
-                for modname, mod in self._modifiers.items():
-                    if mod.get("state") > 0:
-                        keyname = modname + " " + keyname
-                        modkeycode = mod.get("keycode")
-                        keycodeplus = modkeycode + "+" + keycode
-                        if not mod.get("printable"):
-                            printable = False
-                        if direction == PRESSED and self._flashmodifiers:
-                            self._injectKeys(modkeycode, PRESSED)
-                self._injectKeys(keycode, direction)
+                keyname, flash = self._sendEntry(argdict)
+                if direction == PRESSED and self._flashmodifiers:
+                    for keycodes in flash:
+                        self._injectKeys(keycodes, PRESSED)
+                self._injectKeys(argdict["keycodes"], direction)
                 if direction == RELEASED:
+                    if self._trie:
+                        self._trackWord(argdict["name"], keyname)
                     self._releaseModifiers()
-                    if self._viewuntil and re.fullmatch(self._viewuntil, keyname):
+                    if self._viewuntil and self._viewuntil.fullmatch(keyname):
                         self.setView(self._thenview)
-                        self.viewuntil, self._thenview = None, None
+                        self._viewuntil, self._thenview = None, None
 
             if cmd == "view" and direction == RELEASED:
-                viewname = argdict.get("name", "default")
-                self._viewuntil = argdict.get("until")
-                self._thenview = argdict.get("thenview")
+                viewname = argdict["name"]
+                self._viewuntil = argdict["until"]
+                self._thenview = argdict["thenview"]
                 self.setView(viewname)
                 addclass = "oneview" if self._viewuntil else "view"
-                self.setProperty("class", self._view.get("class", "") + addclass)
+                self.setProperty("class", self._view.data.get("class", "") + addclass)
                 self.updateKeyboard()
 
             if cmd == "modifier" and direction == RELEASED:
-                keycode = argdict.get("keycode", "")
-                modifier = argdict.get("name", "")
-                printable = argdict.get("printable", True)
-                modaction = argdict.get("action", "toggle")
+                keycodes = argdict["keycodes"]
+                modifier = argdict["name"]
+                printable = argdict["printable"]
+                modaction = argdict["action"]
                 m = self._modifiers.get(modifier)
+                if m and (m["keycodes"], m["printable"]) != (keycodes, printable):
+                    # Another modifier by the same name, what's in the send tables no longer holds
+                    self._sendtables = {}
+                if modifier not in self._modbits:
+                    self._modbits[modifier] = 1 << len(self._modbits)
                 if modaction == "toggle":
                     if not m or m["state"] == 0:
                         self._modifiers[modifier] = {
                             "state": 1,
-                            "keycode": keycode,
+                            "keycodes": keycodes,
                             "printable": printable,
                         }
                         if not self._flashmodifiers:
-                            self._injectKeys(keycode, PRESSED)
+                            self._injectKeys(keycodes, PRESSED)
                     else:
                         self._modifiers[modifier] = {
                             "state": 0,
-                            "keycode": keycode,
+                            "keycodes": keycodes,
                             "printable": printable,
                         }
                         if not self._flashmodifiers:
-                            self._injectKeys(keycode, RELEASED)
+                            self._injectKeys(keycodes, RELEASED)
                 if modaction == "lock":
                     if not m:
                         self._modifiers[modifier] = {}
                     s = self._modifiers[modifier].get("state", 0)
                     self._modifiers[modifier] = {
                         "state": 0 if s == 2 else 2,
-                        "keycode": keycode,
+                        "keycodes": keycodes,
                         "printable": printable,
                     }
                     if not self._flashmodifiers:
-                        self._injectKeys(keycode, PRESSED if s == 0 else RELEASED)
+                        self._injectKeys(keycodes, PRESSED if s == 0 else RELEASED)
+                self._updateModMask()
                 self.updateKeyboard()
 
             if cmd == "keyboard" and direction == RELEASED:
-                kbdname = argdict.get("name", "")
-                self.setKeyboard(kbdname)
+                self.setKeyboard(argdict["name"])
 
-    # This is where the strings with keycodes to be pressed or released get turned into actual keypress
-    # events. There's two levels here: "42+2;57" (in the US layout) means we're first pressing and then
-    # releasing shift 2 (an exclamation point) and then a space.
+            if cmd == "predict" and direction == RELEASED:
+                if argdict["slot"] < len(self._suggestions):
+                    self._acceptSuggestion(self._suggestions[argdict["slot"]])
 
-    def _injectKeys(self, keystr, direction):
-        keylist = keystr.split(";")
+    #
+    # Word prediction: keeps track of the word being typed from the names of the keys sent, and shows the
+    # most likely completions in the prediction rows of the current view.
+    #
+
+    # name is the name of the key sent, keyname that with the active modifiers in front
+    def _trackWord(self, name, keyname):
+        if name == "backspace":
+            self._word = self._word[:-1]
+        elif len(name) == 1 and name.isalpha() and keyname.split(" ")[:-1] in _WORD_MODIFIERS:
+            self._word += name if keyname == name else name.upper()
+        else:
+            self._word = ""
+        self._showPredictions()
+
+    def _showPredictions(self):
+        slots = self._predictionSlots()
+        if not slots:
+            return
+        self._suggestions = []
+        if self._trie and self._word:
+            completions = self._trie.complete(self._word)
+            if not completions and self._word[0].isupper():
+                completions = self._trie.complete(self._word.lower())
+            # Keep what was typed as it was typed
+            self._suggestions = [self._word + c[len(self._word) :] for c in completions]
+        for key in slots:
+            slot = key.single.commands[0][1]["slot"]
+            key.caption = self._suggestions[slot] if slot < len(self._suggestions) else ""
+            if self._painted:
+                self._view.widget.update(key.widget.rect)
+            else:
+                key.widget.setText(key.caption)
+
+    def _predictionSlots(self):
+        if not self._view:
+            return []
+        return [
+            key
+            for column in self._view.columns
+            for row in column.rows
+            if row.type == "predictions"
+            for key in row.keys
+        ]
+
+    # Types the rest of the word and a space
+    def _acceptSuggestion(self, word):
+        self._typeText(word[len(self._word) :] + " ")
+
+    # Types text with the keys of the current keyboard. Nothing happens if the keyboard has no key for one
+    # of the characters.
+    def _typeText(self, text):
+        actions = [self._charAction(ch) for ch in text]
+        if None in actions:
+            return
+        self._releaseModifiers()
+        for action in actions:
+            self._doAction(action, PRESSED)
+            self._doAction(action, RELEASED)
+
+    # A model.Action that types ch: the single action of a key in any view of the current keyboard that
+    # sends just that.
+    def _charAction(self, ch):
+        actions = self._charactions.get(self._kbdname)
+        if actions is None:
+            actions = {}
+            for key in self._kbd.walk():
+                if not isinstance(key, model.Key) or len(key.single.commands) != 1:
+                    continue
+                cmd, argdict = key.single.commands[0]
+                if cmd == "send" and argdict["printable"]:
+                    if len(argdict["name"]) == 1:
+                        actions.setdefault(argdict["name"], key.single)
+            self._charactions[self._kbdname] = actions
+        return actions.get(ch)
+
+    # This is where the keycodes to be pressed or released get turned into actual keypress events. There's
+    # two levels here: "42+2;57" (in the US layout) means we're first pressing and then releasing shift 2
+    # (an exclamation point) and then a space. The keyboard model has that already parsed into
+    # ((42, 2), (57,)) by model.parseKeycodes().
+
+    def _injectKeys(self, keycodes, direction):
+        if not keycodes:
+            return
 
         # If PRESSED, press and release all the ;-separated keycodes, releasing all but the last
         if direction == PRESSED:
-            for keycodes in keylist:
-                keycodelist = keycodes.split("+")
+            last = len(keycodes) - 1
+            for i, keycodelist in enumerate(keycodes):
                 for keycode in keycodelist:
-                    self._sendKey(int(keycode), PRESSED)
-                    if keycodes != keylist[-1]:
-                        self._sendKey(int(keycode), RELEASED)
+                    self._sendKey(keycode, PRESSED)
+                    if i != last:
+                        self._sendKey(keycode, RELEASED)
 
         # If RELEASED, only need to release the last (set of) keys
         if direction == RELEASED:
-            keycodelist = keylist[-1].split("+")
-            for keycode in reversed(keycodelist):
-                self._sendKey(int(keycode), RELEASED)
+            for keycode in reversed(keycodes[-1]):
+                self._sendKey(keycode, RELEASED)
 
+    # Only actual changes go out: pressing what is already down, or releasing what is not, does nothing.
+    # Modifiers get released after every key, whether they were pressed or not, so that saves a lot.
     def _sendKey(self, keycode, keyevent):
+        if (keycode in self._keysdown) == (keyevent == PRESSED):
+            return
+        if keyevent == PRESSED:
+            self._keysdown[keycode] = True
+        else:
+            del self._keysdown[keycode]
         if self._sendkeys:
             self._sendkeys(keycode, keyevent)
 
+    # Let go of every key that was sent as pressed and not released yet, last pressed first. For when
+    # oskb exits, so nothing stays stuck down.
+    def releaseKeys(self):
+        for keycode in reversed(list(self._keysdown)):
+            self._sendKey(keycode, RELEASED)
+
     def _releaseModifiers(self):
-        if self._view:
+        if self._view and self._modmask:
             donestuff = False
             for modinfo in self._modifiers.values():
                 if modinfo["state"] == 1:
                     donestuff = True
                     if not self._flashmodifiers:
-                        self._injectKeys(modinfo["keycode"], RELEASED)
+                        self._injectKeys(modinfo["keycodes"], RELEASED)
                     modinfo["state"] = 0
                 if self._flashmodifiers:
-                    self._injectKeys(modinfo["keycode"], RELEASED)
+                    self._injectKeys(modinfo["keycodes"], RELEASED)
             if donestuff:
+                self._updateModMask()
                 self.updateKeyboard()
 
+    # The active modifiers as a bitmask, with a bit for each modifier name in self._modbits
+    def _updateModMask(self):
+        mask = 0
+        for modname, modinfo in self._modifiers.items():
+            if modinfo["state"] > 0:
+                mask |= self._modbits[modname]
+        self._modmask = mask
+
+    # What a send command amounts to with the modifiers that are active: the key name with the modifier
+    # names in front (as "until" is matched against), and the keycodes of the modifiers to press with it
+    # in flash mode. Worked out the first time a key is sent with some combination of modifiers and then
+    # kept in a table for that key, so sending is just looking it up.
+    def _sendEntry(self, argdict):
+        table = self._sendtables.get(id(argdict))
+        # The send arguments are kept in there too, so their id() can't be reused while they're in it
+        if table is None:
+            table = (argdict, {})
+            self._sendtables[id(argdict)] = table
+        entry = table[1].get(self._modmask)
+        if entry is None:
+            keyname = argdict["name"]
+            flash = []
+            for modname, modinfo in self._modifiers.items():
+                if modinfo["state"] > 0:
+                    keyname = modname + " " + keyname
+                    flash.append(modinfo["keycodes"])
+            entry = (keyname, tuple(flash))
+            table[1][self._modmask] = entry
+        return entry
+
     # Helper
 
     def _clearLayout(self, layout):
@@ -635,6 +1257,248 @@ class Keyboard(QWidget):
                     self._clearLayout(child.layout())
 
 
+# A PaintedKey stands in for the QPushButton of a key or empty row when the view is drawn by a KeyGrid.
+# Button handlers get passed one of these instead of the button, with the key data in .data and the
+# model.Key or model.Row in .key as usual.
+
+class PaintedKey:
+    __slots__ = ("data", "key", "rect", "down")
+
+    def __init__(self, key):
+        self.data = key.data
+        self.key = key
+        self.rect = QRect()
+        self.down = False
+
+
+# KeyGrid draws all keys of a view in its paintEvent() and does its own hit-testing, instead of having
+# a QPushButton for every key, a QHBoxLayout for every row, QLabels for extra captions, etc. Keys are
+# drawn by rendering hidden template buttons, one for each combination of class, per-key style and
+# extra captions. These are children of the keyboard like regular keys, so all stylesheets apply.
+
+class KeyGrid(QWidget):
+    def __init__(self, keyboard, view):
+        super().__init__(keyboard)
+        self._keyboard = keyboard
+        self._view = view
+        self._keys = []
+        self._pressed = None
+        self._templates = {}
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.setMinimumSize(1, 1)
+
+    def resizeEvent(self, event):
+        QWidget.resizeEvent(self, event)
+        self._layoutKeys()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        # Draw our own background from the stylesheet, plain QWidget subclasses have to do that themselves
+        opt = QStyleOption()
+        opt.initFrom(self)
+        self.style().drawPrimitive(QStyle.PE_Widget, opt, painter, self)
+        for pk in self._keys:
+            if pk.rect.intersects(event.rect()):
+                self._paintKey(painter, pk)
+        painter.end()
+
+    def mousePressEvent(self, event):
+        pk = self.keyAt(event.pos())
+        if not pk:
+            return
+        self._pressed = pk
+        pk.down = True
+        self.update(pk.rect)
+        self._keyboard._buttonhandler(pk, PRESSED)
+
+    def mouseReleaseEvent(self, event):
+        pk = self._pressed
+        if not pk:
+            return
+        self._pressed = None
+        pk.down = False
+        self.update(pk.rect)
+        self._keyboard._buttonhandler(pk, RELEASED)
+
+    def keyAt(self, pos):
+        for pk in self._keys:
+            if pk.rect.contains(pos):
+                return pk
+        return None
+
+    # Same proportions as the QGridLayout and QHBoxLayouts in widget mode: columns according to their width
+    # in units with COLUMN_MARGIN in between, rows according to the heights in the first column, and the
+    # keys of each row stretched to fill it.
+    def _layoutKeys(self):
+        self._keys = []
+        columns = self._view.columns
+        if columns:
+            colunits = []
+            for ci, column in enumerate(columns):
+                if ci > 0:
+                    colunits.append(COLUMN_MARGIN)
+                colunits.append(column.widthinunits or 1)
+            colspans = _spans(colunits, self.width())[::2]
+            rowspans = _spans([row.height for row in columns[0].rows], self.height())
+            for (x, w), column in zip(colspans, columns):
+                for (y, h), row in zip(rowspans, column.rows):
+                    if row.widget:
+                        row.widget.rect = QRect(x, y, w, h)
+                        self._keys.append(row.widget)
+                        continue
+                    for (kx, kw), key in zip(_spans([k.width for k in row.keys], w), row.keys):
+                        key.widget.rect = QRect(x + kx, y, kw, h)
+                        self._keys.append(key.widget)
+        self._view.keyindex = None
+        self._view.swipedecoder = None
+        self.update()
+
+    def _paintKey(self, painter, pk):
+        key = pk.key
+        if key.type == "key":
+            caption, extracaptions = key.caption, key.extracaptions
+        else:
+            caption, extracaptions = "", {}
+        size = pk.rect.size()
+        if not self._keyboard._keycache:
+            pixmap = self._renderKey(key, caption, extracaptions, size, pk.down)
+            painter.drawPixmap(pk.rect.topLeft(), pixmap)
+            return
+        # Everything that the rendered face depends on is in the key. The generation changes on resize
+        # and whenever the stylesheets change, which makes all earlier entries unreachable.
+        cachekey = repr(
+            (
+                "oskb",
+                id(self._keyboard),
+                self._keyboard._keycachegeneration,
+                caption,
+                tuple(extracaptions.items()),
+                key.cls,
+                key.renderedstyle,
+                size.width(),
+                size.height(),
+                pk.down,
+            )
+        )
+        pixmap = QPixmapCache.find(cachekey)
+        if pixmap is None or pixmap.isNull():
+            pixmap = self._renderKey(key, caption, extracaptions, size, pk.down)
+            QPixmapCache.insert(cachekey, pixmap)
+        painter.drawPixmap(pk.rect.topLeft(), pixmap)
+
+    def _renderKey(self, key, caption, extracaptions, size, down):
+        template = self._template(key, extracaptions)
+        # Keep the template outside of our own area, so it never shows up on screen
+        template.setGeometry(-size.width(), -size.height(), size.width(), size.height())
+        template.setText(caption)
+        template.setDown(down)
+        for ql, txt in zip(template.labels, extracaptions.values()):
+            ql.setText(txt)
+            ql.setGeometry(0, 0, size.width(), size.height())
+        return template.grab()
+
+    def _template(self, key, extracaptions):
+        keyclass = key.cls or ""
+        keystyle = key.renderedstyle or ""
+        cachekey = (keyclass, key.style, tuple(extracaptions))
+        template = self._templates.get(cachekey)
+        if not template:
+            template = QPushButton(self)
+            template.setProperty("class", keyclass)
+            template.setAttribute(Qt.WA_TransparentForMouseEvents)
+            template.labels = []
+            for cssclass in extracaptions:
+                ql = QLabel(template)
+                ql.setProperty("class", cssclass)
+                template.labels.append(ql)
+            template.keystyle = None
+            template.move(-template.width(), -template.height())
+            template.show()
+            self._templates[cachekey] = template
+        # Only the rendered per-key style changes with the size of the keyboard
+        if template.keystyle != keystyle:
+            template.setStyleSheet(keystyle)
+            template.keystyle = keystyle
+        return template
+
+
+# The letter a key types, if that is all it does. Only those keys are swiped across.
+def _swipeChar(key):
+    if key.type != "key" or len(key.single.commands) != 1:
+        return None
+    cmd, argdict = key.single.commands[0]
+    if cmd == "send" and len(argdict["name"]) == 1 and argdict["name"].isalpha():
+        return argdict["name"]
+    return None
+
+
+# Milliseconds on the clock the gesture state machine runs on
+def _now():
+    return time.monotonic() * 1000
+
+
+# Divides length pixels over parts proportional to units, returns (start, length) for each
+def _spans(units, length):
+    total = sum(units) or 1
+    spans = []
+    pos = 0
+    for u in units:
+        start = int(round(pos * length / total))
+        pos += u
+        spans.append((start, int(round(pos * length / total)) - start))
+    return spans
+
+
+# Helper function to dynamically recalculate some sizes in stylesheets
+
+_FONTSIZE_PERCENTAGE = re.compile(r"font-size\s*:\s*(\d+)\%")
+
+
+def _fixStyle(stylesheet, fontsize, margin, radius):
+    if stylesheet == "":
+        return ""
+    # Replace the main calculated values
+    stylesheet = stylesheet.replace("_OSKB_FONTSIZE_", str(fontsize))
+    stylesheet = stylesheet.replace("_OSKB_MARGIN_", str(margin))
+    stylesheet = stylesheet.replace("_OSKB_RADIUS_", str(radius))
+    # And then all the percentages based thereon (Qt5 doesn't do percentages in fontsizes)
+    for m in _FONTSIZE_PERCENTAGE.finditer(stylesheet):
+        stylesheet = stylesheet.replace(
+            m.group(0), "font-size: " + str(int((fontsize / 100) * int(m.group(1)))) + "px",
+        )
+    return stylesheet
+
+
+_FONTSIZE_DECLARATION = re.compile(r"font-size\s*:[^;}]*;?")
+
+
+def _stripFontSizes(stylesheet):
+    return _FONTSIZE_DECLARATION.sub("", stylesheet)
+
+
+# Helpers for font scaling mode. Widgets without a pixel font size from the stylesheet are left alone.
+
+def _measureFontScale(widget):
+    widget.ensurePolished()
+    pixelsize = widget.font().pixelSize()
+    if pixelsize <= 0:
+        return None
+    return pixelsize / FONTSCALE_REFERENCE
+
+
+# A widget's own stylesheet with its scaled font size added. Fonts set with setFont() would lose to any
+# stylesheet that applies to the widget, so the size has to be in a stylesheet too.
+
+def _scaledStyle(stylesheet, scale, fontsize):
+    if not scale:
+        return stylesheet
+    declaration = "font-size: " + str(max(int(fontsize * scale), 1)) + "px;"
+    if "{" in stylesheet:
+        return stylesheet + "\n* { " + declaration + " }"
+    stylesheet = stylesheet.strip().rstrip(";")
+    return stylesheet + "; " + declaration if stylesheet else declaration
+
+
 # oskbCopy() copies an oskb data structure (a dict with sub-dicts and sub-lists). If you specify two
 # variables it will move from one to the other without breaking the reference. If you specify just one,
 # it will return a new copy.
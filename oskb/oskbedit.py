@@ -1,4 +1,4 @@
-import sys, os, json, re, pkg_resources, argparse
+import sys, os, json, re, pkg_resources, argparse, tempfile, stat, hashlib
 from functools import partial
 from PyQt5.QtCore import (
     QTimer,
@@ -8,6 +8,9 @@ from PyQt5.QtCore import (
     QSize,
     Qt,
     QMetaObject,
+    QSocketNotifier,
+    QThread,
+    pyqtSignal,
 )
 from PyQt5.QtGui import (
     QIcon,
@@ -48,6 +51,7 @@ from PyQt5.QtWidgets import (
     QWidget,
 )
 import oskb
+from oskb import model
 from oskb.ui_keywizard import Ui_KeyWizard
 from oskb.ui_editkey import Ui_EditKey
 from oskb.ui_keyactions import Ui_KeyActions
@@ -59,11 +63,14 @@ if sys.platform.startswith("linux"):
 
 DOUBLECLICK_TIMEOUT = 350
 MAX_UNDO = 10
+# Number of edits after which the journal is rewritten as a single snapshot
+JOURNAL_COMPACT = 50
 
 def command_line_arguments():
     ap = argparse.ArgumentParser()
     ap.add_argument("--input", "-i", help="input device for key wizard", metavar="<dev>")
     ap.add_argument("--inputlist", help="list input devices and exit", action="store_true")
+    ap.add_argument("--compact", help="save keyboard files without indentation", action="store_true")
     ap.add_argument("keyboard", help="a keyboard file", metavar="<kbd>", nargs="?")
     return ap
 
@@ -119,6 +126,16 @@ class OskbEdit(QWidget):
         self._changed = False
         self._lastclicked = None
         self._copypaste = []
+        self._savethread = None
+        self._edits = 0
+        self._journal = None
+        # Selection index, see _indexKeys()
+        self._positions = {}
+        self._widgets = {}
+        self._order = []
+        self._orderindex = {}
+        self._selkeys = set()
+        self._selrows = set()
         # Size window at half width and third of height of screen, positioned in the middle
         av_height = QDesktopWidget().availableGeometry(self).size().height()
         av_width = QDesktopWidget().availableGeometry(self).size().width()
@@ -147,6 +164,12 @@ class OskbEdit(QWidget):
         self._menu = QMenuBar()
         self._menu.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
         self.layout().setMenuBar(self._menu)
+        self._actions = {}
+        self._menusummary = None
+        self._menu_file()
+        self._menu_edit()
+        self._menu_insert()
+        self._menu_view()
         self.show()
         # Load the file from the command line, or the blank keyboard if none specified
         if g_cmdline.keyboard:
@@ -155,12 +178,42 @@ class OskbEdit(QWidget):
         else:
             self._loadFile("_new")
 
+    # The menus are built once. This only updates what is enabled, checked and so on, and only if anything
+    # they depend on changed since the last time. The actions themselves find their targets in the
+    # selection when triggered.
     def _fixMenu(self):
-        self._menu.clear()
-        self._menu_file()
-        self._menu_edit()
-        self._menu_insert()
-        self._menu_view()
+        selrows, selkeys = self._surveySelected()
+        w = self._firstSelWidget()
+        summary = (
+            selrows,
+            selkeys,
+            w.key.type if w else None,
+            self._undo[0][0] if self._undo else None,
+            self._redo[0][0] if self._redo else None,
+            self._changed,
+            self._savefilename,
+            bool(self._copypaste),
+            self._mode,
+            tuple(self._kbd["views"]),
+            self._viewname,
+        )
+        if summary == self._menusummary:
+            return
+        self._menusummary = summary
+        self._menu_file_fix()
+        self._menu_edit_fix(selrows, selkeys, w)
+        self._menu_insert_fix(selrows, selkeys)
+        self._menu_view_fix()
+
+    # Helper to make a menu item
+    def _menuItem(self, menu, name, text, slot, shortcut=None):
+        item = QAction(text, self)
+        item.triggered.connect(slot)
+        if shortcut:
+            item.setShortcut(shortcut)
+        menu.addAction(item)
+        self._actions[name] = item
+        return item
 
     #
     # "File" menu
@@ -168,37 +221,30 @@ class OskbEdit(QWidget):
 
     def _menu_file(self):
         filemenu = self._menu.addMenu("&File")
-        newitem = filemenu.addAction("&New")
-        newitem.setShortcut("Ctrl+N")
-        newitem.triggered.connect(partial(self._loadFile, "_new"))
-        loaditem = filemenu.addAction("&Open file")
-        loaditem.triggered.connect(self._file_open)
-        loaditem.setShortcut("Ctrl+O")
+        a = partial(self._menuItem, filemenu)
+        a("new", "&New", partial(self._loadFile, "_new"), "Ctrl+N")
+        a("open", "&Open file", self._file_open, "Ctrl+O")
         builtinmenu = filemenu.addMenu("open &Builtin")
         for k in pkg_resources.resource_listdir("oskb", "keyboards"):
             if not k.startswith("_"):
                 builtinitem = QAction(k, self)
                 builtinitem.triggered.connect(partial(self._loadFile, k))
                 builtinmenu.addAction(builtinitem)
-        saveitem = filemenu.addAction("&Save")
-        if not self._savefilename or not self._changed:
-            saveitem.setEnabled(False)
-        else:
-            saveitem.triggered.connect(partial(self._saveFile, self._savefilename))
-            saveitem.setShortcut("Ctrl+S")
-        saveasitem = filemenu.addAction("Save &As")
-        if self._changed:
-            saveasitem.triggered.connect(self._file_save_as)
-            if not self._savefilename:
-                saveasitem.setShortcut("Ctrl+S")
-        else:
-            saveasitem.setEnabled(False)
+        a("save", "&Save", self._file_save)
+        a("saveas", "Save &As", self._file_save_as)
+        compact = a("compact", "Save &Compact", lambda: None)
+        compact.setCheckable(True)
+        compact.setChecked(g_cmdline.compact)
         filemenu.addSeparator()
-        exitButton = QAction("&Quit", self)
-        exitButton.setShortcut("Ctrl+Q")
-        exitButton.setStatusTip("Exit application")
-        exitButton.triggered.connect(self.close)
-        filemenu.addAction(exitButton)
+        a("quit", "&Quit", self.close, "Ctrl+Q").setStatusTip("Exit application")
+
+    def _menu_file_fix(self):
+        a = self._actions
+        cansave = bool(self._savefilename and self._changed)
+        a["save"].setEnabled(cansave)
+        a["save"].setShortcut("Ctrl+S" if cansave else "")
+        a["saveas"].setEnabled(self._changed)
+        a["saveas"].setShortcut("Ctrl+S" if self._changed and not self._savefilename else "")
 
     def _file_open(self):
         if self._changed and not self._areyousure():
@@ -236,6 +282,11 @@ class OskbEdit(QWidget):
             del self._kbds["_chooser"]
         except:
             pass
+        # Keyboards read by the keyboard widget share data with anything read from the same files, including
+        # what they extend. Edit a copy of our own, which also makes saving write out the whole keyboard.
+        self._kbds[self._kbdname] = oskb.oskbCopy(self._kbds[self._kbdname])
+        model.padRows(self._kbds[self._kbdname])
+        g_oskbwidget.initKeyboards()
         self._kbd = self._kbds[self._kbdname]
         self._viewname = g_oskbwidget.getView()
         self._view = self._kbd["views"][self._viewname]
@@ -243,7 +294,25 @@ class OskbEdit(QWidget):
         g_oskbwidget.show()
         self._undo = []
         self._redo = []
+        # See if there's unsaved work from an earlier session that didn't end well
+        if self._journal:
+            self._journal.discard()
+        self._journal = Journal(self._savefilename or f)
+        recovered = self._journal.recover()
+        if recovered and (
+            QMessageBox.question(
+                self,
+                "Recover",
+                "There are unsaved changes to this keyboard from an earlier session. Recover them?",
+                QMessageBox.Yes | QMessageBox.No,
+                QMessageBox.Yes,
+            )
+            == QMessageBox.Yes
+        ):
+            oskb.oskbCopy(recovered, self._kbd)
+            self._changed = True
         self._previouskbd = oskb.oskbCopy(self._kbd)
+        self._journal.start(self._previouskbd, self._changed)
         self._stir()
         return True
 
@@ -262,6 +331,9 @@ class OskbEdit(QWidget):
         else:
             return False
 
+    def _file_save(self):
+        self._saveFile(self._savefilename)
+
     def _file_save_as(self):
         dialog = QFileDialog()
         dialog.setFileMode(QFileDialog.AnyFile)
@@ -271,16 +343,44 @@ class OskbEdit(QWidget):
             filenames = dialog.selectedFiles()
             self._saveFile(*filenames)
 
+    # The actual writing happens in a SaveThread, from a copy of the keyboard made here
     def _saveFile(self, f):
-        savecopy = oskb.oskbCopy(self._kbd)
-        with open(f, "w") as outfile:
-            json.dump(savecopy, outfile, ensure_ascii=False, indent=4)
-        self._changed = False
+        if self._savethread:
+            self._savethread.wait()
+        compact = self._actions["compact"].isChecked()
+        self._savethread = SaveThread(oskb.oskbCopy(self._kbd), f, compact)
+        self._savethread.progress.connect(self._saveProgress)
+        self._savethread.done.connect(partial(self._saveDone, self._edits))
+        self.setWindowTitle("oskbedit - saving")
+        self._savethread.start()
+
+    def _saveProgress(self, written):
+        self.setWindowTitle("oskbedit - saving (" + str(int(written / 1024)) + " kB)")
+
+    def _saveDone(self, edits, filename, error):
+        self.setWindowTitle("oskbedit")
+        if error:
+            QMessageBox.warning(
+                self,
+                "save failed",
+                "Could not save " + filename + ": " + error,
+                QMessageBox.Ok,
+                QMessageBox.Ok,
+            )
+        elif edits == self._edits:
+            # Only unchanged if nothing was edited while saving
+            self._changed = False
+            self._journal.start(self._previouskbd, False)
+        self._fixMenu()
 
     def closeEvent(self, event):
         if self._changed and not self._areyousure():
             event.ignore()
             return
+        if self._savethread:
+            self._savethread.wait()
+        if self._journal:
+            self._journal.discard()
         event.accept()
 
     #
@@ -288,106 +388,73 @@ class OskbEdit(QWidget):
     #
 
     def _menu_edit(self):
-        selrows, selkeys = self._surveySelected()
-        sel = selrows + selkeys
         editmenu = self._menu.addMenu("&Edit")
-        if len(self._undo):
-            undoitem = QAction("&Undo " + self._undo[0][0], self)
-            undoitem.triggered.connect(self._edit_undo)
-        else:
-            undoitem = QAction("&Undo", self)
-            undoitem.setEnabled(False)
-        undoitem.setShortcut("Ctrl+Z")
-        editmenu.addAction(undoitem)
-        if len(self._redo):
-            redoitem = QAction("&Redo " + self._redo[0][0], self)
-            redoitem.triggered.connect(self._edit_redo)
-        else:
-            redoitem = QAction("Redo", self)
-            redoitem.setEnabled(False)
-        redoitem.setShortcut("Shift+Ctrl+Z")
-        editmenu.addAction(redoitem)
+        a = partial(self._menuItem, editmenu)
+        a("undo", "&Undo", self._edit_undo, "Ctrl+Z")
+        a("redo", "Redo", self._edit_redo, "Shift+Ctrl+Z")
         editmenu.addSeparator()
-        cutitem = QAction("Cut", self)
-        cutitem.setShortcut("Ctrl+X")
-        cutitem.triggered.connect(self._edit_cut)
-        cutitem.setEnabled(selkeys > 0 and selrows == 0)
-        editmenu.addAction(cutitem)
-        copyitem = QAction("Copy", self)
-        copyitem.setShortcut("Ctrl+C")
-        copyitem.triggered.connect(self._edit_copy)
-        copyitem.setEnabled(selkeys > 0 and selrows == 0)
-        editmenu.addAction(copyitem)
-        pasteafteritem = QAction("&Paste", self)
-        pasteafteritem.setShortcut("Ctrl+V")
-        if not self._copypaste or sel == 0 or (selrows > 0 and selkeys > 0) or selrows > 1:
-            pasteafteritem.setEnabled(False)
-        else:
-            if selkeys > 0:
-                pasteafteritem.triggered.connect(partial(self._edit_paste, self._lastSelKey(), 1))
-                editmenu.addAction(pasteafteritem)
-
-                pastebeforeitem = QAction("Paste &Before Selected", self)
-                pastebeforeitem.triggered.connect(partial(self._edit_paste, self._firstSelKey()))
-                editmenu.addAction(pastebeforeitem)
-            elif selrows == 1:
-                pasteafteritem.triggered.connect(partial(self._edit_paste, self._firstSelRow()))
-        editmenu.addAction(pasteafteritem)
-        deleteitem = QAction("&Delete", self)
-        deleteitem.setShortcut("Del")
-        deleteitem.triggered.connect(self._edit_delete)
-        deleteitem.setEnabled(sel > 0)
-        editmenu.addAction(deleteitem)
-        deleterowitem = QAction("Delete &Row", self)
-        deleterowitem.triggered.connect(partial(self._edit_delete_row, self._firstSel()))
-        deleterowitem.setEnabled(sel == 1)
-        editmenu.addAction(deleterowitem)
-        deletecolumnitem = QAction("Delete &Column", self)
-        deletecolumnitem.triggered.connect(partial(self._edit_delete_column, self._firstSel()))
-        deletecolumnitem.setEnabled(sel == 1)
-        editmenu.addAction(deletecolumnitem)
+        a("cut", "Cut", self._edit_cut, "Ctrl+X")
+        a("copy", "Copy", self._edit_copy, "Ctrl+C")
+        a("paste", "&Paste", self._edit_paste_after, "Ctrl+V")
+        a("pastebefore", "Paste &Before Selected", self._edit_paste_before)
+        a("delete", "&Delete", self._edit_delete, "Del")
+        a("deleterow", "Delete &Row", self._edit_delete_selected_row)
+        a("deletecolumn", "Delete &Column", self._edit_delete_selected_column)
         editmenu.addSeparator()
-        editkeyitem = QAction("Edit &Key/Spacer", self)
-        if sel != 1 or selrows > 0:
-            editkeyitem.setEnabled(False)
-        else:
-            w = self._firstSelWidget()
-            if w.data.get("type", "key") == "key":
-                editkeyitem.triggered.connect(partial(self._edit_key, w))
-            elif w.data.get("type", "key") == "spacer":
-                editkeyitem.triggered.connect(partial(self._edit_spacer, w))
-        editmenu.addAction(editkeyitem)
-        editrowitem = QAction("Edit &Row", self)
-        if sel != 1:
-            editrowitem.setEnabled(False)
-        else:
-            if selkeys == 1:
-                _, ri, _ = self._firstSelKey()
-            else:
-                _, ri, _ = self._firstSelRow()
-            # heights are only stored in first column
-            editrowitem.triggered.connect(partial(self._edit_row, ri))
-        editmenu.addAction(editrowitem)
-        propitem = QAction("&Keyboard Properties", self)
-        propitem.triggered.connect(self._edit_properties)
-        editmenu.addAction(propitem)
+        a("editkey", "Edit &Key/Spacer", self._edit_selected_key)
+        a("editrow", "Edit &Row", self._edit_selected_row)
+        a("properties", "&Keyboard Properties", self._edit_properties)
 
+    def _menu_edit_fix(self, selrows, selkeys, w):
+        a = self._actions
+        sel = selrows + selkeys
+        a["undo"].setEnabled(bool(self._undo))
+        a["undo"].setText("&Undo " + self._undo[0][0] if self._undo else "&Undo")
+        a["redo"].setEnabled(bool(self._redo))
+        a["redo"].setText("&Redo " + self._redo[0][0] if self._redo else "Redo")
+        a["cut"].setEnabled(selkeys > 0 and selrows == 0)
+        a["copy"].setEnabled(selkeys > 0 and selrows == 0)
+        canpaste = not (not self._copypaste or sel == 0 or (selrows > 0 and selkeys > 0) or selrows > 1)
+        a["paste"].setEnabled(canpaste)
+        a["pastebefore"].setVisible(canpaste and selkeys > 0)
+        a["delete"].setEnabled(sel > 0)
+        a["deleterow"].setEnabled(sel == 1)
+        a["deletecolumn"].setEnabled(sel == 1)
+        a["editkey"].setEnabled(
+            sel == 1 and selrows == 0 and w.key.type in ("key", "spacer")
+        )
+        a["editrow"].setEnabled(sel == 1)
+
+    # Undo and redo entries are (actionname, viewname, before, after), with before and after patches as
+    # made by kbdPatch(). Applying them is journaled like any other change.
     def _edit_undo(self):
-        actionname, actionview, kbd = self._undo.pop(0)
-        self._redo.insert(0, (actionname, self._viewname, oskb.oskbCopy(self._kbd)))
-        oskb.oskbCopy(kbd, self._kbd)
-        self._stir()
+        entry = self._undo.pop(0)
+        self._redo.insert(0, entry)
+        self._applyEdit("Undo " + entry[0], entry[2])
 
     def _edit_redo(self):
-        actionname, actionview, kbd = self._redo.pop(0)
-        self._undo.insert(0, (actionname, self._viewname, oskb.oskbCopy(self._kbd)))
-        oskb.oskbCopy(kbd, self._kbd)
+        entry = self._redo.pop(0)
+        self._undo.insert(0, entry)
+        self._applyEdit("Redo " + entry[0], entry[3])
+
+    def _applyEdit(self, actionname, patch):
+        applyPatch(self._kbd, patch)
+        self._previouskbd = oskb.oskbCopy(self._kbd)
+        self._changed = True
+        self._edits += 1
+        self._journal.append(actionname, patch, self._previouskbd)
         self._stir()
 
     def _edit_delete(self):
         self._copyCut(True)
         self._stir("Delete")
 
+    def _edit_delete_selected_row(self):
+        self._edit_delete_row(self._firstSel())
+
+    def _edit_delete_selected_column(self):
+        self._edit_delete_column(self._firstSel())
+
     def _edit_delete_row(self, tuple):
         if len(self._view["columns"][0]["rows"]) == 1:
             QMessageBox.warning(self, "Delete", "You cannot delete the last row", QMessageBox.Ok)
@@ -412,6 +479,15 @@ class OskbEdit(QWidget):
         self._copypaste = self._copyCut(True)
         self._stir("Cut")
 
+    def _edit_paste_after(self):
+        if self._selkeys:
+            self._edit_paste(self._lastSelKey(), 1)
+        else:
+            self._edit_paste(self._firstSelRow())
+
+    def _edit_paste_before(self):
+        self._edit_paste(self._firstSelKey())
+
     def _edit_paste(self, tuple, after=0):
         ci, ri, ki = tuple
         for ins in self._copypaste:
@@ -420,11 +496,11 @@ class OskbEdit(QWidget):
 
     def _copyCut(self, cut=False):
         buffer = []
-        for ci, ri, ki, keydata in self._reverseIterateKeys():
-            if keydata.get("_selected", False):
-                buffer.append(oskb.oskbCopy(keydata))
-                if cut:
-                    del self._view["columns"][ci]["rows"][ri]["keys"][ki]
+        for ci, ri, ki in sorted(self._selkeys, reverse=True):
+            rowkeys = self._view["columns"][ci]["rows"][ri]["keys"]
+            buffer.append(oskb.oskbCopy(rowkeys[ki]))
+            if cut:
+                del rowkeys[ki]
         return buffer
 
     def _edit_properties(self):
@@ -432,72 +508,73 @@ class OskbEdit(QWidget):
             self._stir("Edit Properties")
 
     def _edit_spacer(self, widget):
-        if ValueEdit(widget.data, "width", 0.5).exec():
+        if ValueEdit(widget.data, "width", 0.5, g_oskbwidget.refreshKey).exec():
             self._stir("Edit Spacer")
 
     def _edit_row(self, ri):
         dict = self._view["columns"][0]["rows"][ri]
-        if ValueEdit(dict, "height").exec():
+        if ValueEdit(dict, "height", 1, g_oskbwidget.refreshRow).exec():
             self._stir("Edit Row")
 
     def _edit_key(self, widget):
         if EditKey(widget).exec():
             self._stir("Edit Key")
 
+    def _edit_selected_key(self):
+        w = self._firstSelWidget()
+        if w.key.type == "key":
+            self._edit_key(w)
+        elif w.key.type == "spacer":
+            self._edit_spacer(w)
+
+    def _edit_selected_row(self):
+        # heights are only stored in first column
+        if self._selkeys:
+            _, ri, _ = self._firstSelKey()
+        else:
+            _, ri, _ = self._firstSelRow()
+        self._edit_row(ri)
+
     #
     # "Insert" menu
     #
 
     def _menu_insert(self):
-        selrows, selkeys = self._surveySelected()
-        sel = selrows + selkeys
         keymenu = self._menu.addMenu("&Insert")
-        insertkmenu = keymenu.addMenu("&Key")
-        insertsmenu = keymenu.addMenu("&Spacer")
-        if sel == 0 or (selrows > 0 and selkeys > 0) or selrows > 1:
-            insertkmenu.setEnabled(False)
-            insertsmenu.setEnabled(False)
-        elif selkeys > 0:
-            addkbefore = QAction("&Before Selected", self)
-            addkbefore.triggered.connect(partial(self._insert_key, self._firstSelKey()))
-            insertkmenu.addAction(addkbefore)
-            addkafter = QAction("&After Selected", self)
-            addkafter.triggered.connect(partial(self._insert_key, self._lastSelKey(), 1))
-            addkafter.setShortcut("Ctrl+K")
-            insertkmenu.addAction(addkafter)
-            addsbefore = QAction("&Before Selected", self)
-            addsbefore.triggered.connect(partial(self._insert_spacer, self._firstSelKey()))
-            insertsmenu.addAction(addsbefore)
-            addsafter = QAction("&After Selected", self)
-            addsafter.triggered.connect(partial(self._insert_spacer, self._lastSelKey(), 1))
-            insertsmenu.addAction(addsafter)
-        elif selrows == 1:
-            addkon = QAction("&On Selected Row", self)
-            addkon.triggered.connect(partial(self._insert_key, self._firstSelRow()))
-            addkon.setShortcut("Ctrl+K")
-            insertkmenu.addAction(addkon)
-            addson = QAction("&On Selected Row", self)
-            addson.triggered.connect(partial(self._insert_spacer, self._firstSelRow()))
-            insertsmenu.addAction(addson)
-        insertrmenu = keymenu.addMenu("&Row")
-        insertcmenu = keymenu.addMenu("&Column")
-        if sel != 1:
-            insertrmenu.setEnabled(False)
-            insertcmenu.setEnabled(False)
+        self._insertmenus = {}
+        for kind, text in (("key", "&Key"), ("spacer", "&Spacer"), ("row", "&Row"), ("column", "&Column")):
+            submenu = keymenu.addMenu(text)
+            self._insertmenus[kind] = submenu
+            a = partial(self._menuItem, submenu)
+            a(kind + "before", "&Before Selected", partial(self._insert_selected, kind))
+            a(kind + "after", "&After Selected", partial(self._insert_selected, kind, 1))
+            if kind in ("key", "spacer"):
+                a(kind + "on", "&On Selected Row", partial(self._insert_selected, kind))
+
+    def _menu_insert_fix(self, selrows, selkeys):
+        a = self._actions
+        sel = selrows + selkeys
+        keyspacer = not (sel == 0 or (selrows > 0 and selkeys > 0) or selrows > 1)
+        for kind in ("key", "spacer"):
+            self._insertmenus[kind].setEnabled(keyspacer)
+            a[kind + "before"].setVisible(selkeys > 0)
+            a[kind + "after"].setVisible(selkeys > 0)
+            a[kind + "on"].setVisible(selkeys == 0)
+        # Only one of these is visible at a time, and only that one gets the shortcut
+        a["keyafter"].setShortcut("Ctrl+K" if selkeys > 0 else "")
+        a["keyon"].setShortcut("Ctrl+K" if selkeys == 0 else "")
+        for kind in ("row", "column"):
+            self._insertmenus[kind].setEnabled(sel == 1)
+
+    def _insert_selected(self, kind, after=0):
+        if kind in ("key", "spacer"):
+            if self._selkeys:
+                curpos = self._lastSelKey() if after else self._firstSelKey()
+            else:
+                curpos, after = self._firstSelRow(), 0
         else:
             curpos = self._firstSel()
-            addrbefore = QAction("&Before Selected", self)
-            addrbefore.triggered.connect(partial(self._insert_row, curpos))
-            insertrmenu.addAction(addrbefore)
-            addrafter = QAction("&After Selected", self)
-            addrafter.triggered.connect(partial(self._insert_row, curpos, 1))
-            insertrmenu.addAction(addrafter)
-            addcbefore = QAction("&Before Selected", self)
-            addcbefore.triggered.connect(partial(self._insert_column, curpos))
-            insertcmenu.addAction(addcbefore)
-            addcafter = QAction("&After Selected", self)
-            addcafter.triggered.connect(partial(self._insert_column, curpos, 1))
-            insertcmenu.addAction(addcafter)
+        getattr(self, "_insert_" + kind)(curpos, after)
 
     def _insert_key(self, tuple, after=0):
         ci, ri, ki = tuple
@@ -517,11 +594,12 @@ class OskbEdit(QWidget):
             else:
                 wiz = None
         if not wiz:
+            model.padRows(self._kbd)
             g_oskbwidget.initKeyboards()
-            self._edit_key(rowkeys[ki + after]["_QWidget"])
+            self._edit_key(g_oskbwidget.keyFor(rowkeys[ki + after]).widget)
         self._stir("Insert Key")
         self._selectState(False)
-        self._selectState(True, rowkeys[ki + after]["_QWidget"])
+        self._selectState(True, g_oskbwidget.keyFor(rowkeys[ki + after]).widget)
         g_oskbwidget.updateKeyboard()
         self._fixMenu()
 
@@ -531,7 +609,7 @@ class OskbEdit(QWidget):
         rowkeys.insert(ki + after, {"type": "spacer", "width": 0.5})
         self._stir("Insert Spacer")
         self._selectState(False)
-        self._selectState(True, rowkeys[ki + after]["_QWidget"])
+        self._selectState(True, g_oskbwidget.keyFor(rowkeys[ki + after]).widget)
         g_oskbwidget.updateKeyboard()
         self._fixMenu()
 
@@ -552,38 +630,46 @@ class OskbEdit(QWidget):
 
     def _menu_view(self):
         viewmenu = self._menu.addMenu("&View")
+        self._viewmenu = viewmenu
+        a = partial(self._menuItem, viewmenu)
         mag = QActionGroup(self)
-        editmodeitem = QAction("&Edit mode", self)
-        editmodeitem.triggered.connect(self._view_editmode)
-        editmodeitem.setCheckable(True)
-        editmodeitem.setChecked(self._mode == "edit")
-        editmodeitem.setShortcut("Ctrl+E")
-        viewmenu.addAction(editmodeitem)
-        mag.addAction(editmodeitem)
-        testmodeitem = QAction("&Test mode", self)
-        testmodeitem.triggered.connect(self._view_testmode)
-        testmodeitem.setCheckable(True)
-        testmodeitem.setChecked(self._mode == "test")
-        testmodeitem.setShortcut("Ctrl+T")
-        viewmenu.addAction(testmodeitem)
-        mag.addAction(testmodeitem)
-        if self._mode == "edit":
-            viewmenu.addSeparator()
-            vag = QActionGroup(self)
-            for vn, v in self._kbd["views"].items():
-                va = QAction(vn, vag)
+        for item in (
+            a("editmode", "&Edit mode", self._view_editmode, "Ctrl+E"),
+            a("testmode", "&Test mode", self._view_testmode, "Ctrl+T"),
+        ):
+            item.setCheckable(True)
+            mag.addAction(item)
+        # The list of views goes between these two separators in edit mode
+        self._viewlistseparators = (viewmenu.addSeparator(), viewmenu.addSeparator())
+        self._viewactions = []
+        self._viewgroup = QActionGroup(self)
+        self._viewlist = None
+        a("addview", "&Add New View", self._view_add)
+        a("deleteview", "&Delete Current View", self._view_delete)
+
+    def _menu_view_fix(self):
+        a = self._actions
+        a["editmode"].setChecked(self._mode == "edit")
+        a["testmode"].setChecked(self._mode == "test")
+        for separator in self._viewlistseparators:
+            separator.setVisible(self._mode == "edit")
+        # Only make new actions for the views if the list of views changed
+        viewlist = tuple(self._kbd["views"]) if self._mode == "edit" else ()
+        if viewlist != self._viewlist:
+            self._viewlist = viewlist
+            for va in self._viewactions:
+                self._viewmenu.removeAction(va)
+                self._viewgroup.removeAction(va)
+                va.deleteLater()
+            self._viewactions = []
+            for vn in viewlist:
+                va = QAction(vn, self._viewgroup)
                 va.setCheckable(True)
-                if v == self._view:
-                    va.setChecked(True)
                 va.triggered.connect(partial(self._view_switch, vn))
-                viewmenu.addAction(va)
-            viewmenu.addSeparator()
-        addviewitem = QAction("&Add New View", self)
-        addviewitem.triggered.connect(self._view_add)
-        viewmenu.addAction(addviewitem)
-        delviewitem = QAction("&Delete Current View", self)
-        delviewitem.triggered.connect(self._view_delete)
-        viewmenu.addAction(delviewitem)
+                self._viewmenu.insertAction(self._viewlistseparators[1], va)
+                self._viewactions.append(va)
+        for vn, va in zip(viewlist, self._viewactions):
+            va.setChecked(vn == self._viewname)
 
     def _view_editmode(self):
         self._mode = "edit"
@@ -601,6 +687,7 @@ class OskbEdit(QWidget):
         g_oskbwidget.setView(viewname)
         self._view = self._kbd["views"][viewname]
         self._viewname = viewname
+        self._indexKeys()
         self._fixMenu()
 
     def _view_delete(self):
@@ -639,24 +726,25 @@ class OskbEdit(QWidget):
     #
 
     def _buttonHandler(self, widget, direction):
+        # Dialogs trying out changes can have recreated the key widgets since the last index
+        if widget not in self._positions:
+            self._indexKeys()
         if direction == oskb.PRESSED:
             # Read only once, is not state now but of last click event
             mod = QGuiApplication.keyboardModifiers()
             if mod & Qt.ControlModifier:
-                self._selectState(not widget.data.get("_selected", False), widget)
+                self._selectState(not widget.key.selected, widget)
             elif mod & Qt.ShiftModifier:
                 if self._lastclicked:
-                    if widget.data.get("type") == "emptyrow":
+                    if widget.key.type == "emptyrow":
                         return
-                    selecting = False
-                    for ci, ri, ki, keydata in self._iterateKeys():
-                        thisone = keydata["_QWidget"]
-                        if thisone == self._lastclicked:
-                            selecting = not selecting
-                        if thisone == widget:
-                            selecting = not selecting
-                        if selecting or thisone == widget:
+                    # Everything from the first of the two up to (not including) the second, plus the
+                    # one clicked on
+                    if self._lastclicked in self._orderindex and widget in self._orderindex:
+                        first, last = sorted((self._orderindex[self._lastclicked], self._orderindex[widget]))
+                        for thisone in self._order[first:last]:
                             self._selectState(True, thisone)
+                    self._selectState(True, widget)
             else:
                 if self._doubletimer.isActive():
                     self._doubleClick(widget)
@@ -664,7 +752,7 @@ class OskbEdit(QWidget):
                     self._doubletimer.start(DOUBLECLICK_TIMEOUT)
                     self._selectState(False)
                     self._selectState(True, widget)
-        if widget.data.get("type") == "emptyrow":
+        if widget.key.type == "emptyrow":
             self._lastclicked = None
         else:
             self._lastclicked = widget
@@ -672,9 +760,9 @@ class OskbEdit(QWidget):
         self._fixMenu()
 
     def _doubleClick(self, widget):
-        if widget.data.get("type") == "spacer":
+        if widget.key.type == "spacer":
             self._edit_spacer(widget)
-        elif widget.data.get("type", "key") == "key":
+        elif widget.key.type == "key":
             self._edit_key(widget)
 
     #
@@ -685,11 +773,17 @@ class OskbEdit(QWidget):
     def _stir(self, actionname=None):
         if actionname:
             self._changed = True
-            self._undo.insert(0, (actionname, self._viewname[:], oskb.oskbCopy(self._previouskbd)))
-            self._previouskbd = oskb.oskbCopy(self._kbd)
+            self._edits += 1
+            # Only what changed is kept for undo and written to the journal
+            newkbd = oskb.oskbCopy(self._kbd)
+            before, after = kbdPatch(newkbd, self._previouskbd), kbdPatch(self._previouskbd, newkbd)
+            self._undo.insert(0, (actionname, self._viewname[:], before, after))
+            self._journal.append(actionname, after, newkbd)
+            self._previouskbd = newkbd
             while len(self._undo) > MAX_UNDO:
                 self._undo.pop(len(self._undo) - 1)
             self._redo = []
+        model.padRows(self._kbd)
         g_oskbwidget.initKeyboards()
         # g_oskbwidget.updateKeyboard()
         self._view_switch(g_oskbwidget.getView())
@@ -701,45 +795,69 @@ class OskbEdit(QWidget):
             viewlist.append(view["name"])
         return viewlist
 
+    # The selection index: _positions maps each key widget to its (ci, ri, ki) and each empty row widget
+    # to its (ci, ri) in the current view, _widgets is the reverse of that. _order has the key widgets in
+    # view order, with their position in that list in _orderindex. _selkeys and _selrows hold the positions
+    # of what is selected, so that questions about the selection don't need to look at every key. It is
+    # rebuilt whenever the keyboard widgets are recreated or the view changes.
+    def _indexKeys(self):
+        self._positions, self._widgets, self._order, self._orderindex = {}, {}, [], {}
+        self._selkeys, self._selrows = set(), set()
+        for ci, ri, rowdata in self._iterateRows():
+            row = g_oskbwidget.keyFor(rowdata)
+            if row.widget:
+                self._positions[row.widget] = (ci, ri)
+                self._widgets[(ci, ri)] = row.widget
+                if row.selected:
+                    self._selrows.add((ci, ri))
+        for ci, ri, ki, keydata in self._iterateKeys():
+            key = g_oskbwidget.keyFor(keydata)
+            w = key.widget
+            self._positions[w] = (ci, ri, ki)
+            self._widgets[(ci, ri, ki)] = w
+            self._orderindex[w] = len(self._order)
+            self._order.append(w)
+            if key.selected:
+                self._selkeys.add((ci, ri, ki))
+
     # Calling without widget selects or deselects everything
     def _selectState(self, newstate, widget=None):
-        for _, _, row in self._iterateRows():
-            if row.get("_QWidget"):
-                if not widget or row.get("_QWidget") == widget:
-                    row["_selected"] = newstate
-        for _, _, _, keydata in self._iterateKeys():
-            if not widget or widget == keydata.get("_QWidget"):
-                keydata["_selected"] = newstate
+        if widget:
+            widgets = [widget]
+        elif newstate:
+            widgets = list(self._positions)
+        else:
+            widgets = [self._widgets[p] for p in self._selkeys | self._selrows]
+        for w in widgets:
+            pos = self._positions.get(w)
+            if not pos:
+                continue
+            w.key.selected = newstate
+            sel = self._selrows if len(pos) == 2 else self._selkeys
+            if newstate:
+                sel.add(pos)
+            else:
+                sel.discard(pos)
 
     def _surveySelected(self):
-        selrows, selkeys = 0, 0
-        for _, _, row in self._iterateRows():
-            if row.get("_QWidget") and row.get("_selected"):
-                selrows += 1
-        for _, _, _, keydata in self._iterateKeys():
-            if keydata.get("_selected"):
-                selkeys += 1
-        return selrows, selkeys
+        return len(self._selrows), len(self._selkeys)
 
     def _firstSelWidget(self):
-        for ci, ri, ki, keydata in self._iterateKeys():
-            if keydata.get("_selected"):
-                return keydata.get("_QWidget")
+        if self._selkeys:
+            return self._widgets[min(self._selkeys)]
 
     def _firstSelKey(self):
-        for ci, ri, ki, keydata in self._iterateKeys():
-            if keydata.get("_selected"):
-                return (ci, ri, ki)
+        if self._selkeys:
+            return min(self._selkeys)
 
     def _lastSelKey(self):
-        for ci, ri, ki, keydata in self._reverseIterateKeys():
-            if keydata.get("_selected"):
-                return (ci, ri, ki)
+        if self._selkeys:
+            return max(self._selkeys)
 
     def _firstSelRow(self):
-        for ci, ri, row in self._iterateRows():
-            if row.get("_QWidget") and row.get("_selected"):
-                return (ci, ri, 0)
+        if self._selrows:
+            ci, ri = min(self._selrows)
+            return (ci, ri, 0)
 
     def _firstSel(self):
         p = self._firstSelKey()
@@ -753,23 +871,192 @@ class OskbEdit(QWidget):
                 for ki, keydata in enumerate(row.get("keys", [])):
                     yield ci, ri, ki, keydata
 
-    def _reverseIterateKeys(self):
-        for ci, column in reversed(list(enumerate(self._view.get("columns", [])))):
-            for ri, row in reversed(list(enumerate(column.get("rows", [])))):
-                for ki, keydata in reversed(list(enumerate(row.get("keys", [])))):
-                    yield ci, ri, ki, keydata
-
     def _iterateRows(self):
         for ci, column in enumerate(self._view.get("columns", [])):
             for ri, row in enumerate(column.get("rows", [])):
                 yield ci, ri, row
 
 
+#
+# The journal is an append-only file with one JSON object per line, so every edit is on disk right away
+# without having to write the whole keyboard. The first line holds a snapshot of the keyboard and whether
+# that differs from the saved file, every line after that a patch with the changes of one edit. After
+# JOURNAL_COMPACT edits, or when the file is saved, it starts over with a new snapshot. If the editor
+# doesn't get to discard it, recover() replays it to get back the keyboard as it was.
+#
+
+
+class Journal:
+    def __init__(self, kbdfile):
+        cachedir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        self._dir = os.path.join(cachedir, "oskbedit")
+        kbdfile = os.path.abspath(kbdfile) if os.path.isfile(kbdfile) else kbdfile
+        digest = hashlib.sha1(kbdfile.encode("utf-8")).hexdigest()[:16]
+        self._path = os.path.join(self._dir, os.path.basename(kbdfile) + "-" + digest + ".journal")
+        self._file = None
+        self._entries = 0
+
+    # Returns the keyboard as the journal left it, or None if it has no unsaved changes
+    def recover(self):
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                header = json.loads(f.readline())
+                kbd = header["snapshot"]
+                changed = header.get("changed", False)
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line may have been cut off in a crash
+                        break
+                    applyPatch(kbd, entry["patch"])
+                    changed = True
+        except (OSError, ValueError, KeyError):
+            return None
+        return kbd if changed else None
+
+    def start(self, kbd, changed):
+        if self._file:
+            self._file.close()
+        os.makedirs(self._dir, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(prefix=".journal-", dir=self._dir)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"snapshot": kbd, "changed": changed}, ensure_ascii=False) + "\n")
+        os.replace(tmpname, self._path)
+        self._file = open(self._path, "a", encoding="utf-8")
+        self._entries = 0
+
+    # kbd is the keyboard after the change, used as the new snapshot when compacting
+    def append(self, actionname, patch, kbd):
+        if self._entries >= JOURNAL_COMPACT:
+            self.start(kbd, True)
+            return
+        self._file.write(json.dumps({"action": actionname, "patch": patch}, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._entries += 1
+
+    def discard(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+
+# kbdPatch() returns what needs to change to get from one keyboard to another: changed top-level entries
+# (None if removed), and under "views" the changed views (again None if removed) plus the new order of the
+# views. applyPatch() applies such a patch. Both work on copies without the keyboard widget's own entries.
+
+
+def kbdPatch(old, new):
+    patch = {}
+    for k in list(old) + [k for k in new if k not in old]:
+        if k != "views" and old.get(k) != new.get(k):
+            patch[k] = new.get(k)
+    oldviews, newviews = old.get("views", {}), new.get("views", {})
+    changed = {}
+    for vn in list(oldviews) + [vn for vn in newviews if vn not in oldviews]:
+        if oldviews.get(vn) != newviews.get(vn):
+            changed[vn] = newviews.get(vn)
+    if changed or list(oldviews) != list(newviews):
+        patch["views"] = {"changed": changed, "order": list(newviews)}
+    return patch
+
+
+def applyPatch(kbd, patch):
+    for k, v in patch.items():
+        if k == "views":
+            continue
+        if v is None:
+            kbd.pop(k, None)
+        else:
+            kbd[k] = oskb.oskbCopy(v) if type(v) in (dict, list) else v
+    if "views" in patch:
+        views = kbd.get("views", {})
+        for vn, v in patch["views"]["changed"].items():
+            if v is None:
+                views.pop(vn, None)
+            else:
+                views[vn] = oskb.oskbCopy(v)
+        kbd["views"] = {vn: views[vn] for vn in patch["views"]["order"]}
+
+
+#
+# Saving happens in the background: the file is written to a temporary file in the same directory, which
+# is synced to disk and then renamed over the old one, so a crash halfway through never leaves half a
+# keyboard file. It emits progress with the number of characters written so far, and done with the
+# filename and an error message that is empty if everything worked.
+#
+
+
+class SaveThread(QThread):
+    progress = pyqtSignal(int)
+    done = pyqtSignal(str, str)
+
+    def __init__(self, kbd, filename, compact=False):
+        super().__init__()
+        self._kbd = kbd
+        self._filename = os.path.abspath(filename)
+        self._compact = compact
+        # New files get the permissions open() would give them, mkstemp() makes them private.
+        # The umask can only be read by setting it, so that is done here, in the main thread.
+        umask = os.umask(0o022)
+        os.umask(umask)
+        self._newmode = 0o666 & ~umask
+
+    def run(self):
+        try:
+            self._write()
+        except Exception as e:
+            self.done.emit(self._filename, str(e))
+            return
+        self.done.emit(self._filename, "")
+
+    def _write(self):
+        directory = os.path.dirname(self._filename)
+        fd, tmpname = tempfile.mkstemp(prefix=".oskbedit-", dir=directory)
+        try:
+            if self._compact:
+                encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+            else:
+                encoder = json.JSONEncoder(ensure_ascii=False, indent=4)
+            with os.fdopen(fd, "w", encoding="utf-8") as outfile:
+                written, reported = 0, 0
+                for chunk in encoder.iterencode(self._kbd):
+                    outfile.write(chunk)
+                    written += len(chunk)
+                    if written - reported >= 65536:
+                        self.progress.emit(written)
+                        reported = written
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            if os.path.exists(self._filename):
+                os.chmod(tmpname, stat.S_IMODE(os.stat(self._filename).st_mode))
+            else:
+                os.chmod(tmpname, self._newmode)
+            os.replace(tmpname, self._filename)
+        except BaseException:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+        # Make sure the rename itself is on disk too
+        if hasattr(os, "O_DIRECTORY"):
+            dirfd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+
+
 #
 # Other windows and widgets.
 #
 
 
+# The KeyWizard reads events from the input device as Qt tells us they are there, keeping track of which
+# keys are down. It waits for all keys to be released, and then collects every key that gets pressed
+# until all keys are released again.
+
 class KeyWizard(QDialog):
     def __init__(self):
         super().__init__()
@@ -777,26 +1064,36 @@ class KeyWizard(QDialog):
         self.ui.setupUi(self)
         self.ui.lineEdit.setFocus()
         self.show()
-        QTimer.singleShot(20, self.get_key)
+        self._down = set(g_kbdinput.active_keys())
+        self._armed = not self._down
+        self._pressed = []
+        self._notifier = QSocketNotifier(g_kbdinput.fd, QSocketNotifier.Read, self)
+        self._notifier.activated.connect(self._readEvents)
 
-    def get_key(self):
-        # Wait for all keys to be released, and then a key to be pressed
-        while g_kbdinput.active_keys() != []:
-            pass
-        while g_kbdinput.active_keys() == []:
-            pass
-        pressed = []
-        while True:
-            active = g_kbdinput.active_keys()
-            if active == []:
-                break
-            for k in active:
-                if not k in pressed:
-                    pressed.append(k)
-        result = ""
-        for k in pressed:
-            result += "+" + str(k)
-        self.keycode = result[1:]
+    def _readEvents(self):
+        try:
+            events = list(g_kbdinput.read())
+        except BlockingIOError:
+            return
+        for event in events:
+            # value 2 is autorepeat, which changes nothing
+            if event.type != evdev.ecodes.EV_KEY or event.value == 2:
+                continue
+            if event.value == 1:
+                self._down.add(event.code)
+                if self._armed and event.code not in self._pressed:
+                    self._pressed.append(event.code)
+            else:
+                self._down.discard(event.code)
+            if not self._down:
+                if self._pressed:
+                    self._notifier.setEnabled(False)
+                    self.get_key(self._pressed)
+                    return
+                self._armed = True
+
+    def get_key(self, pressed):
+        self.keycode = "+".join(str(k) for k in pressed)
         QTimer.singleShot(20, partial(self.got_key, pressed))
 
     def got_key(self, pressed):
@@ -840,13 +1137,15 @@ class KbdProperties(QDialog):
         super().accept()
 
 
+# ValueEdit edits one number in a dictionary, calling refresh with the dictionary to show each change
 class ValueEdit(QDialog):
-    def __init__(self, dict, valkey, default=1):
+    def __init__(self, dict, valkey, default, refresh):
         super().__init__()
         self.ui = Ui_ValueEdit()
         self.ui.setupUi(self)
         self._dict = dict
         self._valkey = valkey
+        self._refresh = refresh
         self._backup = dict.get(valkey, default)
         self.ui.doubleSpinBox.setProperty("value", self._backup)
         self.ui.label.setText(valkey.capitalize() + ":")
@@ -855,13 +1154,11 @@ class ValueEdit(QDialog):
 
     def _tryItOut(self):
         self._dict[self._valkey] = round(self.ui.doubleSpinBox.value(), 1)
-        g_oskbwidget.initKeyboards()
-        g_oskbwidget.updateKeyboard()
+        self._refresh(self._dict)
 
     def reject(self):
         self._dict[self._valkey] = self._backup
-        g_oskbwidget.initKeyboards()
-        g_oskbwidget.updateKeyboard()
+        self._refresh(self._dict)
         super().reject()
 
 
@@ -927,14 +1224,12 @@ class EditKey(QDialog):
 
     def _tryItOut(self):
         self._stickBack()
-        g_oskbwidget.initKeyboards()
-        g_oskbwidget.updateKeyboard()
+        g_oskbwidget.refreshKey(self._d)
 
     def reject(self):
         super().reject()
         oskb.oskbCopy(self._backup, self._d)
-        g_oskbwidget.initKeyboards()
-        g_oskbwidget.updateKeyboard()
+        g_oskbwidget.refreshKey(self._d)
 
     def accept(self):
         self._stickBack()
@@ -0,0 +1,156 @@
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#
+# Swipe typing: a word is typed by dragging a finger from letter to letter without lifting it. The path
+# of the finger is resampled to POINTS points at equal distances along it, and compared to the same
+# resampling of the path through the centres of the keys of each candidate word, its template. The
+# closer the paths (along the way and at both ends), and the more frequent the word, the better it scores.
+#
+# Comparing against every word would be slow, so candidates are only words that start on a key near
+# where the swipe started and end on a key near where it ended, and whose template is about as long as
+# the swipe. Templates are made when first needed and kept, grouped by first and last letter, so the
+# scoring is done on arrays with NumPy, which is needed for this.
+#
+# Coordinates are plain numbers, so there's no Qt in here.
+#
+
+# Points both the swipe and the templates are resampled to
+POINTS = 32
+
+# How far from a key a swipe can start or end and still be meant to start or end there, in key sizes
+REACH = 1.0
+
+# Templates much longer or shorter than the swipe are not considered: allowed difference in key sizes,
+# plus this fraction of the length of the swipe
+LENGTH_SLACK = (1.5, 0.4)
+
+# Spread of the swipe around the template of the word meant, in key sizes
+SPREAD = 0.35
+
+# How much a word being more frequent counts against the swipe being closer to another word. Kept small,
+# so frequency only decides between words the swipe is about equally close to: even the least frequent
+# of 100000 words, swiped exactly, beats the most frequent one if that template is on average 0.4 key
+# sizes away.
+FREQUENCY_WEIGHT = 0.05
+
+
+def available():
+    return numpy is not None
+
+
+# The words to pick from, most frequent first. Only words of two or more letters are swiped.
+
+
+class Lexicon:
+    def __init__(self, words):
+        self._buckets = {}
+        seen = set()
+        for rank, word in enumerate(words):
+            word = word.lower()
+            if len(word) < 2 or not word.isalpha() or word in seen:
+                continue
+            seen.add(word)
+            self._buckets.setdefault((word[0], word[-1]), []).append((word, rank))
+
+    def bucket(self, first, last):
+        return self._buckets.get((first, last), [])
+
+
+class SwipeDecoder:
+    # keys are {character: (x, y, width, height)} for the letter keys of a view
+    def __init__(self, lexicon, keys):
+        self._lexicon = lexicon
+        self._centres = {ch: (x + w / 2, y + h / 2) for ch, (x, y, w, h) in keys.items()}
+        sizes = sorted(min(w, h) for x, y, w, h in keys.values())
+        self._size = sizes[len(sizes) // 2] if sizes else 1
+        # Templates by first and last letter: (words, ranks, lengths, resampled paths)
+        self._templates = {}
+
+    # The words the path (a list of (x, y)) was most likely meant to be, at most n, best first
+    def decode(self, path, n=1):
+        if len(path) < 2 or not self._centres:
+            return []
+        swipe = _resample(path)
+        length = _length(path)
+        slack = LENGTH_SLACK[0] * self._size + LENGTH_SLACK[1] * length
+        words, scores = [], []
+        for first in self._near(path[0]):
+            for last in self._near(path[-1]):
+                twords, ranks, lengths, templates = self._bucket(first, last)
+                if not twords:
+                    continue
+                fits = numpy.abs(lengths - length) <= slack
+                if not fits.any():
+                    continue
+                distances = numpy.hypot(*(templates[fits] - swipe).transpose(2, 0, 1))
+                # Where a swipe starts and ends says a lot more than the average distance along it shows
+                z = distances.mean(axis=1) / (SPREAD * self._size)
+                zends = (distances[:, 0] + distances[:, -1]) / (2 * SPREAD * self._size)
+                score = -(z * z + zends * zends) / 2 - FREQUENCY_WEIGHT * numpy.log1p(ranks[fits])
+                words.extend(w for w, f in zip(twords, fits) if f)
+                scores.append(score)
+        if not words:
+            return []
+        scores = numpy.concatenate(scores)
+        best = numpy.argsort(-scores, kind="stable")[:n]
+        return [words[i] for i in best]
+
+    # Letters whose keys are within reach of a point, nearest first
+    def _near(self, point):
+        x, y = point
+        reach = REACH * self._size
+        near = []
+        for ch, (cx, cy) in self._centres.items():
+            d = math.hypot(x - cx, y - cy)
+            if d <= reach:
+                near.append((d, ch))
+        if not near:
+            near = [min((math.hypot(x - cx, y - cy), ch) for ch, (cx, cy) in self._centres.items())]
+        return [ch for d, ch in sorted(near)]
+
+    def _bucket(self, first, last):
+        templates = self._templates.get((first, last))
+        if templates is None:
+            words, ranks, lengths, paths = [], [], [], []
+            for word, rank in self._lexicon.bucket(first, last):
+                if not all(ch in self._centres for ch in word):
+                    continue
+                path = [self._centres[ch] for ch in word]
+                words.append(word)
+                ranks.append(rank)
+                lengths.append(_length(path))
+                paths.append(_resample(path))
+            if words:
+                templates = (words, numpy.array(ranks), numpy.array(lengths), numpy.stack(paths))
+            else:
+                templates = ([], None, None, None)
+            self._templates[(first, last)] = templates
+        return templates
+
+
+# Total length of a path
+
+
+def _length(path):
+    return sum(math.hypot(x2 - x1, y2 - y1) for (x1, y1), (x2, y2) in zip(path, path[1:]))
+
+
+# A path as POINTS points at equal distances along it, as an array of shape (POINTS, 2)
+
+
+def _resample(path):
+    points = numpy.asarray(path, dtype=float)
+    steps = numpy.hypot(*numpy.diff(points, axis=0).T)
+    # Repeated points (double letters, a finger standing still) add nothing to the path
+    moved = steps > 0
+    points = points[numpy.concatenate(([True], moved))]
+    if len(points) == 1:
+        return numpy.repeat(points, POINTS, axis=0)
+    along = numpy.concatenate(([0.0], numpy.cumsum(steps[moved])))
+    at = numpy.linspace(0.0, along[-1], POINTS)
+    return numpy.stack([numpy.interp(at, along, points[:, 0]), numpy.interp(at, along, points[:, 1])], axis=1)
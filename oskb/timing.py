@@ -0,0 +1,176 @@
+import os, json, tempfile
+
+#
+# Adaptive key timing. How long a press has to be to count as a long press, and how quickly a second tap
+# has to follow to count as a double tap, is learned from how the user actually types. For every key (and
+# for all keys together) the last SAMPLES press durations and double tap intervals are kept in ring
+# buffers. The long press threshold is a bit above what nearly all of the user's ordinary taps take, and
+# the double tap timeout a bit above what nearly all of their double taps take, both kept within bounds.
+# Keys with too few samples of their own go by the numbers for all keys, and until there are enough of
+# those, the fixed defaults are used.
+#
+# Times are in milliseconds, passed in by the caller, so there's no Qt or clock in here.
+#
+
+SAMPLES = 64
+MIN_SAMPLES = 8
+
+# Ordinary taps that should stay below the long press threshold
+TAP_PERCENTILE = 95
+TAP_MARGIN = 100
+LONGPRESS_BOUNDS = (200, 800)
+
+# Double taps that should stay below the double tap timeout
+DOUBLE_PERCENTILE = 90
+DOUBLE_MARGIN = 60
+DOUBLECLICK_BOUNDS = (120, 450)
+
+
+class RingBuffer:
+    __slots__ = ("_values", "_next", "_full")
+
+    def __init__(self, size=SAMPLES, values=()):
+        self._values = [0] * size
+        self._next = 0
+        self._full = False
+        for v in values[-size:]:
+            self.add(v)
+
+    def add(self, value):
+        self._values[self._next] = value
+        self._next += 1
+        if self._next == len(self._values):
+            self._next = 0
+            self._full = True
+
+    def __len__(self):
+        return len(self._values) if self._full else self._next
+
+    # Oldest first
+    def values(self):
+        if self._full:
+            return self._values[self._next :] + self._values[: self._next]
+        return self._values[: self._next]
+
+    # Nearest-rank percentile, None if empty
+    def percentile(self, p):
+        values = sorted(self.values())
+        if not values:
+            return None
+        rank = max(int(len(values) * p / 100.0 + 0.5), 1)
+        return values[min(rank, len(values)) - 1]
+
+
+class TimingModel:
+    def __init__(self, longpress, doubleclick):
+        self._default = (longpress, doubleclick)
+        self._taps = {None: RingBuffer()}
+        self._doubles = {None: RingBuffer()}
+        # Learned thresholds by key, None for all keys together. Recalculated when samples come in.
+        self._longpress = {}
+        self._doubleclick = {}
+        # When each key was last released, to see how fast a second tap came
+        self._lastrelease = {}
+        self._pressedat = {}
+        self._newsamples = 0
+
+    def longpressTimeout(self, keyid):
+        return self._longpress.get(keyid) or self._longpress.get(None) or self._default[0]
+
+    def doubleclickTimeout(self, keyid):
+        return self._doubleclick.get(keyid) or self._doubleclick.get(None) or self._default[1]
+
+    # A key went down at time t. If it's a second tap, the interval since the first one is a sample.
+    def pressed(self, keyid, t, secondtap=False):
+        self._pressedat[keyid] = t
+        released = self._lastrelease.get(keyid)
+        if secondtap and released is not None:
+            self._sample(self._doubles, keyid, t - released)
+            self._doubleclick[keyid], self._doubleclick[None] = self._threshold(
+                self._doubles, keyid, DOUBLE_PERCENTILE, DOUBLE_MARGIN, DOUBLECLICK_BOUNDS
+            )
+
+    # A key came up at time t. Only ordinary taps of keys that have a long action are samples for the long
+    # press threshold. Keys without one may well be held down on purpose (autorepeat, modifiers), and
+    # anything held as long as the current threshold would have been a long press, not a tap.
+    def released(self, keyid, t, longpress=False, haslong=True):
+        self._lastrelease[keyid] = t
+        pressed = self._pressedat.pop(keyid, None)
+        if longpress or not haslong or pressed is None:
+            return
+        if t - pressed >= self.longpressTimeout(keyid):
+            return
+        self._sample(self._taps, keyid, t - pressed)
+        self._longpress[keyid], self._longpress[None] = self._threshold(
+            self._taps, keyid, TAP_PERCENTILE, TAP_MARGIN, LONGPRESS_BOUNDS
+        )
+
+    # Number of samples since the last save()
+    def unsaved(self):
+        return self._newsamples
+
+    def _sample(self, buffers, keyid, ms):
+        if keyid not in buffers:
+            buffers[keyid] = RingBuffer()
+        buffers[keyid].add(int(ms))
+        buffers[None].add(int(ms))
+        self._newsamples += 1
+
+    def _threshold(self, buffers, keyid, percentile, margin, bounds):
+        result = []
+        for k in (keyid, None):
+            if len(buffers[k]) < MIN_SAMPLES:
+                result.append(None)
+            else:
+                result.append(min(max(buffers[k].percentile(percentile) + margin, bounds[0]), bounds[1]))
+        return result
+
+    #
+    # Stored per user as JSON, with the samples so learning picks up where it left off
+    #
+
+    def load(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return False
+        for name, buffers in (("taps", self._taps), ("doubles", self._doubles)):
+            for keyid, values in stored.get(name, {}).items():
+                keyid = keyid or None
+                buffers[keyid] = RingBuffer(SAMPLES, [int(v) for v in values])
+        for keyid in list(self._taps):
+            self._longpress[keyid] = self._threshold(
+                self._taps, keyid, TAP_PERCENTILE, TAP_MARGIN, LONGPRESS_BOUNDS
+            )[0]
+        for keyid in list(self._doubles):
+            self._doubleclick[keyid] = self._threshold(
+                self._doubles, keyid, DOUBLE_PERCENTILE, DOUBLE_MARGIN, DOUBLECLICK_BOUNDS
+            )[0]
+        self._newsamples = 0
+        return True
+
+    def save(self, path):
+        stored = {
+            name: {(keyid or ""): buf.values() for keyid, buf in buffers.items()}
+            for name, buffers in (("taps", self._taps), ("doubles", self._doubles))
+        }
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(prefix=".timing-", dir=directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(stored, f)
+            os.replace(tmpname, path)
+        except OSError:
+            os.unlink(tmpname)
+            raise
+        self._newsamples = 0
+
+
+# Where a user's timings are kept if nothing else is specified
+
+
+def defaultPath():
+    configdir = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(configdir, "oskb", "timing.json")
@@ -0,0 +1,187 @@
+import os, mmap, struct, argparse
+
+#
+# A compact word frequency trie for the prediction strip. It is built once from a word list with
+#
+#   python -m oskb.trie <wordlist> <triefile>
+#
+# and then used straight from the file through mmap, so loading it costs nothing and lookups only touch
+# the few pages they need. Every node stores the indexes of the TOP most frequent words below it, so
+# completing a prefix is walking down one node per character (a binary search among its children) and
+# reading off that list. That keeps lookups far below a millisecond, whatever the size of the word list.
+#
+# File layout, all little-endian:
+#
+#   header      magic, version, top, number of nodes, edges and words
+#   words       offset of each word in the text, plus one for the end of the last
+#   nodes       first edge, number of edges, then top word indexes (-1 if fewer), most frequent first
+#   edges       character (as code point), node it leads to. Sorted by character for each node.
+#   text        all the words, UTF-8
+#
+# Node 0 is the root.
+#
+
+MAGIC = b"OSKBTRIE"
+VERSION = 1
+TOP = 5
+
+_HEADER = struct.Struct("<8sIIIII")
+_OFFSET = struct.Struct("<I")
+_EDGE = struct.Struct("<II")
+
+
+class Trie:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._top, nodes, edges, words = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version > VERSION:
+            raise RuntimeError(path + " is not an oskb word trie")
+        self._node = struct.Struct("<II" + "i" * self._top)
+        self._words = _HEADER.size
+        self._nodes = self._words + (words + 1) * _OFFSET.size
+        self._edges = self._nodes + nodes * self._node.size
+        self._text = self._edges + edges * _EDGE.size
+
+    def close(self):
+        self._mm.close()
+
+    # The most frequent words that start with prefix, at most n (and at most what the trie was built
+    # with), most frequent first. The prefix itself is left out.
+    def complete(self, prefix, n=TOP):
+        node = 0
+        for ch in prefix:
+            node = self._child(node, ord(ch))
+            if node is None:
+                return []
+        completions = []
+        for wi in self._node.unpack_from(self._mm, self._nodes + node * self._node.size)[2:]:
+            if wi < 0 or len(completions) == n:
+                break
+            word = self._word(wi)
+            if word != prefix:
+                completions.append(word)
+        return completions
+
+    # All the words, most frequent first
+    def words(self):
+        count = _HEADER.unpack_from(self._mm, 0)[5]
+        for wi in range(count):
+            yield self._word(wi)
+
+    def _child(self, node, codepoint):
+        first, count = self._node.unpack_from(self._mm, self._nodes + node * self._node.size)[:2]
+        lo, hi = first, first + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            ch, child = _EDGE.unpack_from(self._mm, self._edges + mid * _EDGE.size)
+            if ch == codepoint:
+                return child
+            if ch < codepoint:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _word(self, wi):
+        start = _OFFSET.unpack_from(self._mm, self._words + wi * _OFFSET.size)[0]
+        end = _OFFSET.unpack_from(self._mm, self._words + (wi + 1) * _OFFSET.size)[0]
+        return self._mm[self._text + start : self._text + end].decode("utf-8")
+
+
+#
+# Building
+#
+
+# A word list has one word per line, optionally followed by whitespace and a count. Without counts,
+# words are taken to be listed most frequent first.
+
+
+def readWordList(path):
+    counts = {}
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.split() for line in f]
+    lines = [l for l in lines if l]
+    for rank, fields in enumerate(lines):
+        word = fields[0]
+        count = int(fields[1]) if len(fields) > 1 else len(lines) - rank
+        counts[word] = counts.get(word, 0) + count
+    return counts
+
+
+def build(counts, path, top=TOP):
+    words = sorted(counts, key=lambda w: (-counts[w], w))
+    rank = {w: i for i, w in enumerate(words)}
+    # Building nodes: [children by character, word index or None]
+    root = [{}, None]
+    for w in words:
+        node = root
+        for ch in w:
+            node = node[0].setdefault(ch, [{}, None])
+        node[1] = rank[w]
+    # Number the nodes breadth first, so each node's children are next to each other
+    order = [root]
+    ids = {id(root): 0}
+    i = 0
+    while i < len(order):
+        for ch in sorted(order[i][0]):
+            child = order[i][0][ch]
+            ids[id(child)] = len(order)
+            order.append(child)
+        i += 1
+    # Top words for each node, from the leaves up. Word indexes are ranks, so lower is more frequent.
+    tops = [None] * len(order)
+    for ni in range(len(order) - 1, -1, -1):
+        node = order[ni]
+        candidates = [node[1]] if node[1] is not None else []
+        for child in node[0].values():
+            candidates.extend(tops[ids[id(child)]])
+        tops[ni] = sorted(candidates)[:top]
+    offsets = []
+    encoded = [w.encode("utf-8") for w in words]
+    pos = 0
+    for e in encoded:
+        offsets.append(pos)
+        pos += len(e)
+    offsets.append(pos)
+    nodestruct = struct.Struct("<II" + "i" * top)
+    nodes = []
+    edges = []
+    for ni, node in enumerate(order):
+        padded = tops[ni] + [-1] * (top - len(tops[ni]))
+        nodes.append(nodestruct.pack(len(edges), len(node[0]), *padded))
+        for ch in sorted(node[0]):
+            edges.append(_EDGE.pack(ord(ch), ids[id(node[0][ch])]))
+    with open(path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, top, len(nodes), len(edges), len(words)))
+        f.write(b"".join(_OFFSET.pack(o) for o in offsets))
+        f.write(b"".join(nodes))
+        f.write(b"".join(edges))
+        f.write(b"".join(encoded))
+    return len(words), len(nodes)
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        prog="python -m oskb.trie",
+        description="Build a word trie for the oskb prediction strip from a word list.",
+    )
+    ap.add_argument("wordlist", help="One word per line, optionally followed by a count.")
+    ap.add_argument("triefile", help="Where to write the trie.")
+    ap.add_argument(
+        "--top",
+        type=int,
+        default=TOP,
+        metavar="<n>",
+        help="Completions stored per prefix (default %(default)s).",
+    )
+    cmdline = ap.parse_args()
+    nwords, nnodes = build(readWordList(cmdline.wordlist), cmdline.triefile, cmdline.top)
+    print(
+        "%d words, %d nodes, %d bytes written to %s"
+        % (nwords, nnodes, os.path.getsize(cmdline.triefile), cmdline.triefile)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,7 @@ setup(
         'evdev; platform_system == "Linux"',
         'ewmh; platform_system == "Linux"',
     ],
+    extras_require={"swipe": ["numpy"]},  # swipe typing, see swipe.py
     entry_points={
         "console_scripts": [
             # command = package.module:function
@@ -0,0 +1,4 @@
+import os, sys
+
+# Run the tests against the package in this tree, also when started with plain "pytest"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+pytest.importorskip("PyQt5")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtWidgets import QApplication
+from oskb import oskb
+
+app = QApplication.instance() or QApplication([])
+
+
+def _pixelsizes(keyboard, width, height):
+    keyboard.resize(width, height)
+    app.processEvents()
+    keyboard.updateKeyboard()
+    app.processEvents()
+    return [
+        key.widget.font().pixelSize()
+        for column in keyboard._view.columns
+        for row in column.rows
+        for key in row.keys
+        if key.fontscale
+    ]
+
+
+def test_font_follows_resize():
+    keyboard = oskb.Keyboard()
+    keyboard.setFontScaling(True)
+    keyboard.readKeyboards(["paddy-us"])
+    keyboard.setKeyboard("paddy-us")
+    keyboard.show()
+    small, medium, large = (_pixelsizes(keyboard, *size) for size in ((300, 150), (600, 300), (1200, 600)))
+    assert small and len(small) == len(medium) == len(large)
+    assert all(0 < s < m < l < oskb.FONTSCALE_REFERENCE for s, m, l in zip(small, medium, large))
+    # And back again
+    assert _pixelsizes(keyboard, 300, 150) == small
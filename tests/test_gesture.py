@@ -0,0 +1,159 @@
+from oskb import model, gesture
+from oskb.gesture import PRESSED, RELEASED, MOUSE
+
+LONGPRESS = 350
+DOUBLECLICK = 200
+
+
+def _key(ki, **actions):
+    data = {"single": {"send": {"name": "k" + str(ki), "keycode": str(30 + ki)}}}
+    for name, keyname in actions.items():
+        data[name] = {"send": {"name": keyname, "keycode": "1"}}
+    return model.Key(data, ("default", 0, 0), ki)
+
+
+class Recorder:
+    def __init__(self):
+        self.log = []
+        self.machine = gesture.GestureMachine(self.act, self.compensate, LONGPRESS, DOUBLECLICK)
+
+    def act(self, action, direction):
+        self.log.append((action.data["send"]["name"], direction))
+
+    def compensate(self, key):
+        self.log.append(("compensate", key.keyid))
+
+    def taps(self):
+        return [name for name, direction in self.log if direction == RELEASED]
+
+
+def test_single():
+    r = Recorder()
+    key = _key(0)
+    r.machine.press(MOUSE, key, 0)
+    assert r.log == [("k0", PRESSED)]
+    r.machine.release(MOUSE, 80)
+    assert r.log == [("k0", PRESSED), ("k0", RELEASED)]
+    assert r.machine.deadline("long") is None
+    assert r.machine.deadline("double") is None
+
+
+def test_long_key_tapped():
+    r = Recorder()
+    key = _key(0, long="L")
+    r.machine.press(MOUSE, key, 0)
+    assert r.log == []
+    assert r.machine.deadline("long") == LONGPRESS
+    r.machine.release(MOUSE, 100)
+    assert r.log == [("k0", PRESSED), ("k0", RELEASED)]
+
+
+def test_long_press():
+    r = Recorder()
+    key = _key(0, long="L")
+    r.machine.press(MOUSE, key, 0)
+    r.machine.poll(LONGPRESS - 1)
+    assert r.log == []
+    r.machine.poll(LONGPRESS)
+    assert r.log == [("L", PRESSED), ("L", RELEASED)]
+    r.machine.release(MOUSE, 1000)
+    assert r.taps() == ["L"]
+
+
+def test_long_press_decided_by_timestamps():
+    # Events delivered late still give the same result
+    r = Recorder()
+    key = _key(0, long="L")
+    r.machine.press(MOUSE, key, 0)
+    r.machine.release(MOUSE, LONGPRESS + 10)
+    assert r.taps() == ["L"]
+
+
+def test_double():
+    r = Recorder()
+    key = _key(0, double="D")
+    r.machine.press(MOUSE, key, 0)
+    r.machine.release(MOUSE, 50)
+    assert r.log == []
+    assert r.machine.deadline("double") == DOUBLECLICK
+    r.machine.press(MOUSE, key, 120)
+    r.machine.release(MOUSE, 170)
+    assert r.taps() == ["D"]
+    r.machine.poll(10000)
+    assert r.taps() == ["D"]
+
+
+def test_double_times_out():
+    r = Recorder()
+    key = _key(0, double="D")
+    r.machine.press(MOUSE, key, 0)
+    r.machine.release(MOUSE, 50)
+    r.machine.poll(DOUBLECLICK)
+    assert r.taps() == ["k0"]
+    r.machine.press(MOUSE, key, 300)
+    r.machine.release(MOUSE, 350)
+    r.machine.poll(10000)
+    assert r.taps() == ["k0", "k0"]
+
+
+def test_double_interrupted_by_other_key():
+    r = Recorder()
+    key = _key(0, double="D")
+    other = _key(1)
+    r.machine.press(MOUSE, key, 0)
+    r.machine.release(MOUSE, 50)
+    r.machine.press(MOUSE, other, 100)
+    r.machine.release(MOUSE, 150)
+    assert r.taps() == ["k0", "k1"]
+    assert r.machine.deadline("double") is None
+
+
+def test_optimistic_compensate():
+    r = Recorder()
+    r.machine.optimistic = True
+    key = _key(0, double="D")
+    r.machine.press(MOUSE, key, 0)
+    assert r.taps() == ["k0"]
+    r.machine.release(MOUSE, 50)
+    r.machine.press(MOUSE, key, 120)
+    r.machine.release(MOUSE, 170)
+    assert r.log[2:] == [("compensate", key.keyid), ("D", PRESSED), ("D", RELEASED)]
+    r.machine.poll(10000)
+    assert r.taps() == ["k0", "D"]
+
+
+def test_optimistic_without_second_tap():
+    r = Recorder()
+    r.machine.optimistic = True
+    key = _key(0, double="D")
+    r.machine.press(MOUSE, key, 0)
+    r.machine.release(MOUSE, 50)
+    r.machine.poll(10000)
+    assert r.taps() == ["k0"]
+    assert ("compensate", key.keyid) not in r.log
+
+
+def test_two_pointers():
+    r = Recorder()
+    a, b = _key(0), _key(1, long="L")
+    r.machine.press(1, a, 0)
+    r.machine.press(2, b, 10)
+    assert r.log == [("k0", PRESSED)]
+    r.machine.release(1, 100)
+    assert r.log == [("k0", PRESSED), ("k0", RELEASED)]
+    assert r.machine.deadline("long") == 10 + LONGPRESS
+    r.machine.poll(10 + LONGPRESS)
+    assert r.taps() == ["k0", "L"]
+    r.machine.release(2, 1000)
+    assert r.taps() == ["k0", "L"]
+
+
+def test_reset():
+    r = Recorder()
+    key = _key(0, double="D", long="L")
+    r.machine.press(MOUSE, key, 0)
+    r.machine.reset()
+    assert r.machine.deadline("long") is None
+    assert r.machine.deadline("double") is None
+    r.machine.poll(10000)
+    assert r.log == []
@@ -0,0 +1,62 @@
+import pytest
+
+from oskb import swipe
+
+pytest.importorskip("numpy")
+
+# Most frequent first
+WORDS = """the of and to in is you that it he was for on are as with his they at be this have from or one
+had by word but not what all were we when your can said there use an each which she do how their if will
+up other about out many then them these so some her would make like him into time has look two more write
+go see number no way could people my than first water been call who oil its now find long down day did get
+come made may part""".split()
+
+ROWS = ["qwertyuiop", "asdfghjkl", "zxcvbnm"]
+SIZE = 40
+
+
+def _keys():
+    keys = {}
+    for ri, row in enumerate(ROWS):
+        for ki, ch in enumerate(row):
+            keys[ch] = (ki * SIZE + ri * SIZE // 2, ri * SIZE, SIZE, SIZE)
+    return keys
+
+
+def _centres(keys, word):
+    return [(keys[ch][0] + SIZE / 2, keys[ch][1] + SIZE / 2) for ch in word]
+
+
+@pytest.mark.parametrize("word", ["if", "there", "its", "out", "her", "the", "of", "water", "people"])
+def test_exact_path_is_the_word(word):
+    keys = _keys()
+    decoder = swipe.SwipeDecoder(swipe.Lexicon(WORDS), keys)
+    assert decoder.decode(_centres(keys, word))[0] == word
+
+
+def test_exact_path_beats_frequent_word_in_small_list():
+    keys = _keys()
+    decoder = swipe.SwipeDecoder(swipe.Lexicon(["hello", "help"]), keys)
+    assert decoder.decode(_centres(keys, "help"))[0] == "help"
+    assert decoder.decode(_centres(keys, "hello"))[0] == "hello"
+
+
+def test_every_word_decodes_to_itself():
+    keys = _keys()
+    decoder = swipe.SwipeDecoder(swipe.Lexicon(WORDS), keys)
+    for word in WORDS:
+        if len(word) > 1:
+            assert decoder.decode(_centres(keys, word))[0] == word
+
+
+def test_frequency_decides_between_identical_paths():
+    keys = _keys()
+    # Double letters add nothing to the path, so these have the same template
+    decoder = swipe.SwipeDecoder(swipe.Lexicon(["too", "to"]), keys)
+    assert decoder.decode(_centres(keys, "to"), 2) == ["too", "to"]
+
+
+def test_nothing_near():
+    keys = _keys()
+    decoder = swipe.SwipeDecoder(swipe.Lexicon(WORDS), keys)
+    assert decoder.decode([(0, 0)]) == []
@@ -0,0 +1,69 @@
+from oskb import model, gesture, timing
+
+
+def _key(ki, **actions):
+    data = {"single": {"send": {"name": "k" + str(ki), "keycode": str(30 + ki)}}}
+    data.update(actions)
+    return model.Key(data, ("default", 0, 0), ki)
+
+
+def _machine():
+    m = gesture.GestureMachine(lambda action, direction: None, lambda key: None, 350, 200)
+    m.timing = timing.TimingModel(350, 200)
+    return m
+
+
+def _tap(m, key, t, duration):
+    m.press(gesture.MOUSE, key, t)
+    m.release(gesture.MOUSE, t + duration)
+    return t + duration + 1000
+
+
+def test_taps_learn_longpress_threshold():
+    m = _machine()
+    key = _key(0, long={"send": {"name": "K", "keycode": "42+30"}})
+    t = 0
+    for i in range(20):
+        t = _tap(m, key, t, 90)
+    # 90 ms taps plus the margin, kept within bounds
+    assert m.timing.longpressTimeout(key.keyid) == timing.LONGPRESS_BOUNDS[0]
+    assert m.timing.longpressTimeout("unknown") == timing.LONGPRESS_BOUNDS[0]
+
+
+def test_held_keys_leave_threshold_alone():
+    m = _machine()
+    key = _key(0, long={"send": {"name": "K", "keycode": "42+30"}})
+    backspace = _key(1)
+    t = 0
+    for i in range(20):
+        t = _tap(m, key, t, 90)
+    before = m.timing.longpressTimeout("unknown")
+    for i in range(3):
+        t = _tap(m, backspace, t, 2500)
+    assert m.timing.longpressTimeout("unknown") == before
+    assert m.timing.longpressTimeout(backspace.keyid) == before
+
+
+def test_long_presses_are_not_taps():
+    tm = timing.TimingModel(350, 200)
+    for i in range(timing.MIN_SAMPLES):
+        tm.pressed("a", i * 1000)
+        tm.released("a", i * 1000 + 100)
+    threshold = tm.longpressTimeout("a")
+    tm.pressed("a", 100000)
+    tm.released("a", 100000 + threshold + 50)
+    assert tm.longpressTimeout("a") == threshold
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "timing.json")
+    tm = timing.TimingModel(350, 200)
+    for i in range(timing.MIN_SAMPLES):
+        tm.pressed("a", i * 1000)
+        tm.released("a", i * 1000 + 150)
+    assert tm.unsaved() == timing.MIN_SAMPLES
+    tm.save(path)
+    assert tm.unsaved() == 0
+    loaded = timing.TimingModel(350, 200)
+    assert loaded.load(path)
+    assert loaded.longpressTimeout("a") == tm.longpressTimeout("a")